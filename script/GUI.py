@@ -1,17 +1,24 @@
-import cv2
 import numpy as np
 import subprocess
+import threading
+import time
+from concurrent.futures import CancelledError
 from PyQt6.QtWidgets import (
     QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QWidget,
     QFileDialog, QSlider, QCheckBox, QSpinBox, QComboBox
 )
-from PyQt6.QtGui import QPixmap, QImage
-from PyQt6.QtCore import QTimer, Qt
+from PyQt6.QtGui import QPixmap, QPainter, QPen, QColor, QPolygon
+from PyQt6.QtCore import QTimer, Qt, QPoint
 from dataReader import DataReader
+from multiFileReader import MultiFileReader
 from contrastAdjustment import ContrastAdjustment
+from displayRenderer import DisplayRenderer
+from intensityHistograms import IntensityHistograms
 import roiAdapter as roiA
 import roiComputation as roiC
-from segmentation import Segmentation
+from segmentation import Segmentation, label_contours
+from segmentationCache import SegmentationCache
+from summarySegmentation import SummarySegmentation
 from mplCanvas import MplCanvas
 from csvAdapter import write_F_to_csv
 from multiselectComboBox import MultiSelectComboBox
@@ -38,6 +45,14 @@ class Gui(QWidget):
         self.load_roi_button.clicked.connect(self.load_roi)
         self.buttons_layout.addWidget(self.load_roi_button)
 
+        self.build_cache_button = QPushButton("Build cache")
+        self.build_cache_button.clicked.connect(self.build_cache)
+        self.buttons_layout.addWidget(self.build_cache_button)
+
+        self.motion_button = QPushButton("Correct motion")
+        self.motion_button.clicked.connect(self.correct_motion)
+        self.buttons_layout.addWidget(self.motion_button)
+
         self.metadata_layout = QVBoxLayout()
         self.metadata_labels = {}
         self.buttons_layout.addLayout(self.metadata_layout)
@@ -47,6 +62,13 @@ class Gui(QWidget):
         self.segment_button = QPushButton("Segmentation")
         self.segment_button.clicked.connect(self.perform_segmentation)
         self.buttons_layout.addWidget(self.segment_button)
+        self.segment_backend_combo_box = QComboBox()  # U-Net, or cells found on a summary image of the recording
+        self.segment_backend_combo_box.addItems(["U-Net","Correlation image","Mean image","Max image"])
+        self.buttons_layout.addWidget(self.segment_backend_combo_box)
+        self.segment_stack_checkbox = QCheckBox("Segment whole recording")  # Consensus over frames sampled along the recording
+        self.buttons_layout.addWidget(self.segment_stack_checkbox)
+        self.segment_tiled_checkbox = QCheckBox("Full resolution")  # Overlapping tiles instead of a resized frame
+        self.buttons_layout.addWidget(self.segment_tiled_checkbox)
 
         self.modify_roi_button = QPushButton("Modify ROI")  # Nouveau bouton
         self.modify_roi_button.clicked.connect(self.modify_roi)
@@ -79,6 +101,7 @@ class Gui(QWidget):
         self.slider.setTickPosition(QSlider.TickPosition.TicksBelow)
         self.slider.setTickInterval(1)
         self.slider.valueChanged.connect(self.seek_video)
+        self.slider.sliderReleased.connect(self.update_frame) # Back to full resolution after scrubbing
         self.image_layout.addWidget(self.slider)
 
         self.image_buttons_layout = QHBoxLayout()
@@ -106,6 +129,8 @@ class Gui(QWidget):
         self.contrast_auto_button = QPushButton("Auto contrast")
         self.contrast_auto_button.clicked.connect(self.auto_contrast)
         self.contrast_buttons_layout.addWidget(self.contrast_auto_button)
+        self.contrast_whole_checkbox = QCheckBox("Whole recording")  # Auto contrast from all frames of the channel
+        self.contrast_buttons_layout.addWidget(self.contrast_whole_checkbox)
         self.contrast_min_spinbox = QSpinBox()
         self.contrast_min_spinbox.setRange(0,100000)
         self.contrast_min_spinbox.editingFinished.connect(lambda: self.contrast_min_update_v(self.contrast_min_spinbox.value()))
@@ -125,6 +150,8 @@ class Gui(QWidget):
         self.dff_compute_button = QPushButton("Compute dF/F")
         self.dff_compute_button.clicked.connect(self.compute_dff)
         self.contrast_layout.addWidget(self.dff_compute_button)
+        self.neuropil_checkbox = QCheckBox("Neuropil correction")  # Saves F minus 0.7 times the neuropil around each ROI
+        self.contrast_layout.addWidget(self.neuropil_checkbox)
         self.dff_plot_buttons_layout = QHBoxLayout()
         self.dff_plot_button = QPushButton("Plot dF/F :")
         self.dff_plot_button.clicked.connect(self.plot_dff)
@@ -149,6 +176,7 @@ class Gui(QWidget):
         self.roi_file_path = None  # Stocker le chemin du ROI
         self.global_contours = None  # Store contours permanently for the whole video
         self.global_labels = None
+        self.roi_label_image = None  # Label image of segmented ROIs, None for ROIs loaded from a file
         
         self.tiff_loaded = False
         self.roi_loaded = False
@@ -157,37 +185,60 @@ class Gui(QWidget):
         self.timer = QTimer()
         self.timer.timeout.connect(self.timer_timeout)
         self.timer_timing = 100 #Default to 100ms between slices when playing the video
+        self.dff_thread = None  # dF/F computed in the background, the button showing its progress
+        self.dff_cancel = threading.Event()
+        self.dff_timer = QTimer()
+        self.dff_timer.timeout.connect(self.update_dff_progress)
+        self.cache_thread = None  # Cache built in the background from its own reader, swapped in once done
+        self.cache_timer = QTimer()
+        self.cache_timer.timeout.connect(self.update_cache_progress)
+        self.motion_thread = None  # Shifts estimated in the background, the displayed reader being wrapped once done
+        self.motion_timer = QTimer()
+        self.motion_timer.timeout.connect(self.update_motion_progress)
         self.contrast_adjuster = ContrastAdjustment()
+        self.renderer = DisplayRenderer()
         self.contrast_min,self.contrast_max = None,None
-        self.segmenter = Segmentation()
+        self.histograms = None
+        # NumPy U-Net when its weights have been exported, frames segmented before are read back from the cache
+        self.segmenter = Segmentation(backend="auto",cache=SegmentationCache())
+        # Load the model once the window is shown, in the background
+        QTimer.singleShot(0,self.segmenter.load_async)
 
     def load_image(self):
         self.label.setText("Loading...")
 
-        file_path, _ = QFileDialog.getOpenFileName(self, "Open a File", "", "TIFF Files (*.tiff *.tif)")
-        if file_path:
-            self.tiff_file_path = file_path  # Stocker le chemin du TIFF
+        # Several files are read as one session, in name order
+        file_paths, _ = QFileDialog.getOpenFileNames(self, "Open a File", "", "TIFF Files (*.tiff *.tif)")
+        if file_paths:
+            file_paths = sorted(file_paths)
+            self.tiff_file_path = file_paths[0]  # Stocker le chemin du TIFF
+            self.dff_cancel.set()  # A computation on the previous recording ends without updating the plots
             if self.data:
+                if self.histograms:
+                    self.histograms.cancel()
                 self.data.close()
                 self.tiff_loaded = False
-            self.data = DataReader(file_path)
+            self.data = DataReader(file_paths[0]) if len(file_paths) == 1 else MultiFileReader(file_paths)
             self.tiff_loaded = True
+            self.motion_button.setText("Correct motion")
 
             if self.tiff_loaded:
                 for key in self.data.metadata:
                     if isinstance(self.data.metadata[key],str):
                         if key in self.metadata_labels:
                             self.metadata_labels[key].setText(key+": "+self.data.metadata[key])
+                            self.metadata_labels[key].show()
                         else:
                             self.metadata_labels[key] = QLabel(key+": "+self.data.metadata[key])
                             self.metadata_layout.addWidget(self.metadata_labels[key])
                 for key in self.metadata_labels:
                     if not key in self.data.metadata:
-                        self.metadata_layout.removeWidget(self.metadata_labels[key])
+                        self.metadata_labels[key].hide()
                 self.slider.setMaximum(int(self.data.metadata["SizeT"]) - 1)
                 self.current_frame = 0
                 self.slider.setValue(self.current_frame)
-                self.timer_timing = int(float(self.data.metadata["TimeIncrement"])*1000)
+                if "TimeIncrement" in self.data.metadata:
+                    self.timer_timing = int(float(self.data.metadata["TimeIncrement"])*1000)
                 self.label.setText("")
                 self.channel_combo_box.clear()
                 for i in range(len(self.data.metadata["Channels"])):
@@ -195,9 +246,17 @@ class Gui(QWidget):
                 self.channel_combo_box.currentIndexChanged.connect(self.channel_combo_box_update)
                 if "UR" in self.data.metadata["Channels"]:
                     self.channel_combo_box.setCurrentText("UR")
-                self.contrast_min,self.contrast_max = (int(self.data.get_slice(self.channel_selected,self.current_frame).min()),int(self.data.get_slice(self.channel_selected,self.current_frame).max()))
+                img = self.data.get_slice(self.channel_selected,self.current_frame)
+                self.contrast_min,self.contrast_max = int(img.min()),int(img.max())
                 self.image_select_spinbox.setRange(0,int(self.data.metadata["SizeT"])-1)
-            print(f"TIFF File Loaded: {self.tiff_file_path}")  # Debugging
+                # Count histograms in the background, starting with the displayed channel
+                try:
+                    self.histograms = IntensityHistograms(self.data)
+                    channels = [self.channel_selected]+[c for c in range(len(self.data.metadata["Channels"])) if c != self.channel_selected]
+                    self.histograms.build_async(channels)
+                except ValueError:
+                    self.histograms = None
+            print(f"TIFF File Loaded: {', '.join(file_paths)}")  # Debugging
             self.update_frame()
 
     def load_roi(self):
@@ -205,6 +264,7 @@ class Gui(QWidget):
         if file_path:
             self.roi_file_path = file_path  # Stocker le chemin du ROI
             self.global_contours, self.global_labels = roiA.load_roi(file_path)
+            self.roi_label_image = None
             self.dff_multi_combo_box.addItems(self.global_labels)
             self.update_frame()
             self.roi_loaded = True
@@ -213,7 +273,8 @@ class Gui(QWidget):
     def channel_combo_box_update(self):
         self.channel_selected = self.channel_combo_box.currentIndex()
         self.contrast_checkbox.setChecked(False)
-        self.contrast_min,self.contrast_max = (int(self.data.get_slice(self.channel_selected,self.current_frame).min()),int(self.data.get_slice(self.channel_selected,self.current_frame).max()))
+        img = self.data.get_slice(self.channel_selected,self.current_frame)
+        self.contrast_min,self.contrast_max = int(img.min()),int(img.max())
         self.update_frame()
 
     def image_select_update_v(self,value):
@@ -222,6 +283,9 @@ class Gui(QWidget):
 
     def auto_contrast(self):
         if self.tiff_loaded:
+            if self.contrast_whole_checkbox.isChecked() and self.histograms and self.histograms.channel_done[self.channel_selected]:
+                self.contrast_min,self.contrast_max = self.histograms.contrast_bounds(self.channel_selected)
+            else:
                 _,self.contrast_min,self.contrast_max = self.contrast_adjuster.select_contrast(self.data.get_slice(self.channel_selected,self.current_frame))
         self.contrast_checkbox.setChecked(True)
         self.update_frame()
@@ -242,23 +306,79 @@ class Gui(QWidget):
 
     def plot_histogram(self):
         if self.tiff_loaded:
-            image = self.data.get_slice(self.channel_selected,self.current_frame)
-            histo, _ = np.histogram(image,int(image.max()))
+            # Counts come from the precomputed histograms once the frame has been counted
+            frame_histogram = self.histograms.frame_histogram(self.channel_selected,self.current_frame) if self.histograms else None
+            if frame_histogram is not None:
+                intensities,histo = frame_histogram
+                shown = (intensities+self.histograms.bin_width > self.contrast_min) & (intensities <= self.contrast_max)
+            else:
+                image = self.data.get_slice(self.channel_selected,self.current_frame)
+                # np.histogram rather than np.bincount, for float and signed images too
+                histo,edges = np.histogram(image,max(int(image.max()),1))
+                intensities = edges[:-1]
+                shown = (intensities >= self.contrast_min) & (intensities <= self.contrast_max)
             self.histogram_plot.axes.cla()
-            self.histogram_plot.axes.plot(histo[self.contrast_min:self.contrast_max+1])
+            self.histogram_plot.axes.plot(intensities[shown],histo[shown])
             self.histogram_plot.axes.set_title("Intensity")
             self.histogram_plot.draw()
             self.contrast_min_spinbox.setValue(self.contrast_min)
             self.contrast_max_spinbox.setValue(self.contrast_max)
 
     def compute_dff(self):
+        if self.dff_thread is not None:
+            # Clicking again cancels
+            self.dff_cancel.set()
+            return
         if(self.tiff_loaded and self.roi_loaded):
             file_path, _ = QFileDialog.getSaveFileName(self, "Save intensity over time", "", "CSV file (*.csv)")
+            if not file_path:
+                return
             self.dff_compute_button.setText("Compute dF/F (in progress)")
-            masks = roiC.contours_to_masks(self.global_contours)
-            self.f_data,self.dff_data = roiC.compute_dff(self.data,masks,self.channel_selected)
-            write_F_to_csv(file_path,self.global_labels,self.f_data)
-            self.dff_compute_button.setText("Compute dF/F (done)")
+            # Segmented ROIs are summed pixel for pixel from their label image, those of a ROI file from their contours
+            masks = self.roi_label_image if self.roi_label_image is not None else roiC.contours_to_masks(self.global_contours)
+            self.dff_cancel = threading.Event()
+            self.dff_progress,self.dff_result,self.dff_error,self.dff_start = (0,1),None,None,time.perf_counter()
+            # Own reader, the displayed one staying with the GUI thread, which also reads the widgets and labels for the worker
+            neuropil_factor = 0.7 if self.neuropil_checkbox.isChecked() else None
+            args = (self.data.reopen(),masks,file_path,self.channel_selected,list(self.global_labels),neuropil_factor,self.dff_cancel)
+            self.dff_thread = threading.Thread(target=self._compute_dff_thread,args=args,daemon=True)
+            self.dff_thread.start()
+            self.dff_timer.start(250)
+
+    def _compute_dff_thread(self, reader, masks, file_path, channel, labels, neuropil_factor, cancel):
+        try:
+            self.dff_result = roiC.compute_dff(reader,masks,channel,progress=self._set_dff_progress,cancel=cancel,neuropil_factor=neuropil_factor)
+            write_F_to_csv(file_path,labels,self.dff_result[-1] if neuropil_factor else self.dff_result[0])
+        except CancelledError:
+            self.dff_result = None
+        except Exception as e:
+            print(f" dF/F computation failed : {e}")
+            self.dff_result,self.dff_error = None,e
+        finally:
+            reader.close()
+
+    def _set_dff_progress(self, done, total):
+        self.dff_progress = (done,total)
+
+    def update_dff_progress(self):
+        done,total = self.dff_progress
+        if self.dff_thread.is_alive():
+            if self.dff_cancel.is_set():
+                self.dff_compute_button.setText("Compute dF/F (cancelling)")
+            elif done:
+                remaining = (time.perf_counter()-self.dff_start)*(total-done)/done
+                self.dff_compute_button.setText(f"Compute dF/F ({100*done//total}%, {remaining:.0f} s left, click to cancel)")
+            return
+        self.dff_timer.stop()
+        self.dff_thread = None
+        if self.dff_error is not None:
+            self.dff_compute_button.setText("Compute dF/F (failed)")
+            return
+        if self.dff_result is None or self.dff_cancel.is_set():
+            self.dff_compute_button.setText("Compute dF/F (cancelled)")
+            return
+        self.f_data,self.dff_data = self.dff_result[:2]
+        self.dff_compute_button.setText("Compute dF/F (done)")
 
     def plot_dff(self):
         self.dff_plot.axes.cla()
@@ -272,33 +392,112 @@ class Gui(QWidget):
         self.current_frame = (self.current_frame + 1) % int(self.data.metadata["SizeT"])
         self.slider.setValue(self.current_frame)
         self.update_frame()
+        # Decode the next frames in the background while this one is displayed
+        self.data.prefetch(self.channel_selected,self.current_frame)
+
+    def build_cache(self):
+        if self.tiff_loaded and self.cache_thread is None:
+            self.build_cache_button.setText("Build cache (in progress)")
+            self.cache_source,self.cache_result = self.data,None
+            self.cache_thread = threading.Thread(target=self._build_cache_thread,args=(self.data.reopen(),),daemon=True)
+            self.cache_thread.start()
+            self.cache_timer.start(250)
+
+    def _build_cache_thread(self, reader):
+        try:
+            reader.build_store()
+            self.cache_result = reader
+        except Exception as e:
+            print(f" Cache build failed : {e}")
+            reader.close()
+
+    def update_cache_progress(self):
+        if self.cache_thread.is_alive():
+            return
+        self.cache_timer.stop()
+        self.cache_thread = None
+        reader = self.cache_result
+        if reader is None:
+            self.build_cache_button.setText("Build cache (failed)")
+            return
+        if not self.tiff_loaded or self.data is not self.cache_source:
+            # Another recording was opened meanwhile, it finds the cache itself if it is the same file
+            reader.close()
+            return
+        # The reader that built the cache reads from it, it replaces the displayed one
+        self.data.close()
+        self.data = reader
+        if self.histograms:
+            self.histograms.reader = reader
+        self.build_cache_button.setText("Build cache (done)")
+        self.update_frame()
+
+    def correct_motion(self):
+        # Frames of every channel are registered on the displayed channel, then corrected as they are read
+        from motionCorrection import MotionCorrection, CorrectedReader # scipy is only imported when needed
+        if self.tiff_loaded and not isinstance(self.data,CorrectedReader) and self.motion_thread is None:
+            self.motion_button.setText("Correct motion (in progress)")
+            self.motion_source,self.motion_result = self.data,None
+            args = (self.data.reopen(),self.channel_selected,MotionCorrection())
+            self.motion_thread = threading.Thread(target=self._correct_motion_thread,args=args,daemon=True)
+            self.motion_thread.start()
+            self.motion_timer.start(250)
+
+    def _correct_motion_thread(self, reader, channel, correction):
+        try:
+            self.motion_result = (correction.estimate_shifts(reader,channel),correction)
+        except Exception as e:
+            print(f" Motion correction failed : {e}")
+        finally:
+            reader.close()
+
+    def update_motion_progress(self):
+        from motionCorrection import CorrectedReader
+        if self.motion_thread.is_alive():
+            return
+        self.motion_timer.stop()
+        self.motion_thread = None
+        if self.motion_result is None:
+            self.motion_button.setText("Correct motion (failed)")
+            return
+        if not self.tiff_loaded or self.data.file_path != self.motion_source.file_path or isinstance(self.data,CorrectedReader):
+            return # Another recording was opened meanwhile
+        # The displayed reader, possibly swapped for one reading the cache meanwhile, corrects frames as they are read
+        shifts,correction = self.motion_result
+        self.data = CorrectedReader(self.data,shifts,correction)
+        self.motion_button.setText("Correct motion (done)")
+        self.update_frame()
 
     def update_frame(self):
         if self.tiff_loaded:
-            img = self.data.get_slice(self.channel_selected,self.current_frame)
+            # While scrubbing, preview a pyramid level with about one pixel for two on screen
+            level = self.data.level_for_size(self.label.width()//2,self.label.height()//2) if self.slider.isSliderDown() else 1
+            img = self.data.get_slice(self.channel_selected,self.current_frame,level)
             self.slider.setValue(self.current_frame)
             self.image_select_spinbox.setValue(self.current_frame)
-            # Apply contrast adjustment if enabled
-            if self.contrast_checkbox.isChecked():
-                img, _, _ = self.contrast_adjuster.select_contrast(img,new_min=self.contrast_min,new_max=self.contrast_max)
-            self.plot_histogram()
+            if level == 1:
+                self.plot_histogram()
 
-            # Normalize and convert the image to color format
-            img_uint8 = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-            img_color = cv2.cvtColor(img_uint8, cv2.COLOR_GRAY2BGR)
+            # Map the contrast range (or the frame range) to 8 bits grayscale through the renderer lookup table
+            if self.contrast_checkbox.isChecked():
+                q_image = self.renderer.to_qimage(img,self.contrast_min,self.contrast_max)
+            else:
+                q_image = self.renderer.to_qimage(img)
+            pixmap = QPixmap.fromImage(q_image)
 
-            # Always display segmentation contours if they exist
+            # Always display segmentation contours if they exist, painted in color over the grayscale frame
             if self.global_contours:
+                painter = QPainter(pixmap)
                 for i,contour in enumerate(self.global_contours):
-                    points = np.array(contour, dtype=np.int32)
-                    cv2.drawContours(img_color, [points], -1, (255, 0, 0), 1)  # Draw contours in red
-                    cv2.putText(img_color, self.global_labels[i], contour[0], cv2.FONT_HERSHEY_SIMPLEX,0.5, (255, 0, 100), 1, cv2.LINE_AA)
-
-            # Convert to QPixmap and display in the interface
-            height, width, _ = img_color.shape
-            bytes_per_line = 3 * width
-            q_image = QImage(img_color.data, width, height, bytes_per_line, QImage.Format.Format_RGB888)
-            pixmap = QPixmap.fromImage(q_image)
+                    points = np.array(contour, dtype=np.int32).reshape(-1,2)//level
+                    painter.setPen(QPen(QColor(255, 0, 0), 1))  # Draw contours in red
+                    painter.drawPolygon(QPolygon([QPoint(int(x),int(y)) for x,y in points]))
+                    painter.setPen(QColor(255, 0, 100))
+                    painter.drawText(QPoint(int(points[0][0]),int(points[0][1])),self.global_labels[i])
+                painter.end()
+
+            if level != 1:
+                pixmap = pixmap.scaled(self.data.frame_shape[1],self.data.frame_shape[0])
             self.label.setPixmap(pixmap)
 
     # Function to seek to a specific frame
@@ -311,6 +510,8 @@ class Gui(QWidget):
             self.timer.stop()
             self.play_pause_button.setText("Play")
         else:
+            if self.tiff_loaded:
+                self.data.prefetch(self.channel_selected,self.current_frame)
             self.timer.start(self.timer_timing)
             self.play_pause_button.setText("Pause")
 
@@ -318,8 +519,21 @@ class Gui(QWidget):
 
     def perform_segmentation(self):
         if self.tiff_loaded:
-            img = self.data.get_slice(self.channel_selected,self.current_frame)  # Get the current frame
-            self.global_contours = self.segmenter.segment(img)  # Store contours for all frames
+            backend = self.segment_backend_combo_box.currentText()
+            segmenter = self.segmenter if backend == "U-Net" else SummarySegmentation(backend.split()[0].lower())
+            if self.segment_stack_checkbox.isChecked() and segmenter is not self.segmenter:
+                # Summary image of the whole channel, read in a single pass
+                self.roi_label_image = segmenter.segment_reader(self.data,self.channel_selected)
+            elif self.segment_stack_checkbox.isChecked():
+                # Mean probability over frames spread along the recording
+                frames = np.linspace(0,int(self.data.metadata["SizeT"])-1,min(64,int(self.data.metadata["SizeT"]))).astype(int)
+                stack = np.stack([self.data.get_slice(self.channel_selected,int(t)) for t in np.unique(frames)])
+                self.roi_label_image = self.segmenter.segment_stack(stack,tiled=self.segment_tiled_checkbox.isChecked())
+            else:
+                img = self.data.get_slice(self.channel_selected,self.current_frame)  # Get the current frame
+                self.roi_label_image = segmenter.segment(img,tiled=self.segment_tiled_checkbox.isChecked())  # Store ROIs for all frames
+            self.global_contours = label_contours(self.roi_label_image)  # For display and the ROI file
+            self.global_labels = [str(i) for i in range(len(self.global_contours))]
 
             if self.global_contours:
                 self.roi_loaded = True
@@ -328,7 +542,7 @@ class Gui(QWidget):
                 # Demander où enregistrer le fichier ROI
                 save_path, _ = QFileDialog.getSaveFileName(self, "Save ROI File", "", "ROI Files (*.roi)")
                 if save_path:
-                    roiA.write_roi(save_path, self.global_contours, [str(i) for i in range(len(self.global_contours))])
+                    roiA.write_roi(save_path, self.global_contours, self.global_labels)
                     print(f"ROI file saved at {save_path}")
                     self.roi_file_path = save_path  # Met à jour le chemin du ROI file après l'enregistrement
 
@@ -336,12 +550,13 @@ class Gui(QWidget):
 
     def modify_roi(self):
         if self.tiff_loaded and self.roi_loaded:
-            print(f"Opening ROI Editor for:\n - TIFF: {self.tiff_file_path}\n - ROI: {self.roi_file_path}")
+            tiff_file_path,page = self.data.locate(self.channel_selected,self.current_frame)
+            print(f"Opening ROI Editor for:\n - TIFF: {tiff_file_path}\n - ROI: {self.roi_file_path}")
             subprocess.run([
                             "python", "modifROI.py",
-                            self.tiff_file_path,
+                            tiff_file_path,
                             self.roi_file_path,
-                            str(self.current_frame + self.channel_selected*int(self.data.metadata["SizeT"])),
+                            str(page),
                             str(self.contrast_min),
                             str(self.contrast_max)
                         ], check=True)
@@ -352,12 +567,16 @@ class Gui(QWidget):
         """Resets all paths, contours, and the displayed image."""
         print("Resetting application...")
 
+        if self.histograms:
+            self.histograms.cancel()
+            self.histograms = None
         self.data.close()
         self.tiff_loaded,self.roi_loaded = False,False
         self.tiff_file_path = None
         self.roi_file_path = None
         self.global_contours = None
         self.global_labels = None
+        self.roi_label_image = None
         self.current_frame = 0
         self.slider.setMaximum(0)
         self.slider.setValue(0)
@@ -369,6 +588,9 @@ class Gui(QWidget):
         self.timer.stop()
         self.timer_timing = 100
         self.play_pause_button.setText("Play")
+        self.dff_cancel.set()  # A computation still running ends without updating the plots
         self.dff_compute_button.setText("Compute dF/F")
+        self.build_cache_button.setText("Build cache")
+        self.motion_button.setText("Correct motion")
 
         print("Application reset completed.")
@@ -4,9 +4,63 @@ class ContrastAdjustment:
     def __init__(self):
         pass
 
+    def histogram(self,image):
+        """Returns np.histogram(image,int(image.max()))[0], the histogram the contrast band is selected from
+
+        Integer images are counted once with np.bincount and only their distinct values are binned, which
+        gives the same counts as binning every pixel.
+        """
+        origin_min,origin_max = image.min(),image.max()
+        if np.issubdtype(image.dtype,np.integer) and int(origin_max)-int(origin_min) < 2**24:
+            # Widened first, signed ranges wider than the type's maximum would wrap
+            counts = np.bincount(image.ravel().astype(np.int64)-int(origin_min),minlength=int(origin_max)-int(origin_min)+1)
+            return self.histogram_from_counts(counts,image.dtype,int(origin_min))
+        histogram,_ = np.histogram(image,int(origin_max))
+        return histogram
+
+    def histogram_from_counts(self,counts,dtype,offset=0):
+        """Same as histogram, for an integer image given by the number of pixels of each intensity
+
+        Args:
+            counts (numpy.ndarray): counts[i] is the number of pixels of intensity offset+i
+            dtype (numpy.dtype): integer type of the image
+            offset (int,optional): intensity of counts[0]. Defaults to 0
+        """
+        present = np.flatnonzero(counts)
+        origin_min,origin_max = np.dtype(dtype).type(offset+present[0]),np.dtype(dtype).type(offset+present[-1])
+        values = np.arange(int(origin_min),int(origin_max)+1).astype(dtype)
+        histogram,_ = np.histogram(values,int(origin_max),range=(origin_min,origin_max),weights=counts[present[0]:present[-1]+1])
+        return histogram
+
+    def band(self,histogram,size,criteria=10000,new_min=-1,new_max=-1):
+        """Selects the bounds of the contrast band from a histogram, see select_contrast
+
+        Args:
+            histogram (numpy.ndarray): histogram returned by histogram or histogram_from_counts
+            size (int): number of pixels counted in the histogram
+
+        Returns:
+            int : lower bound of the band
+            int : upper bound of the band
+        """
+        criteria = size/criteria
+        above = np.flatnonzero(histogram > criteria)
+
+        if new_min == -1:
+            # First bin over the criteria before new_max, none when new_max is being searched too
+            new_min = int(above[above < new_max][0]) if (above < new_max).any() else 0
+
+        if new_max == -1:
+            # Last bin over the criteria after new_min
+            new_max = int(above[above > new_min][-1]) if (above > new_min).any() else histogram.size-1
+
+        return new_min,new_max
+
     def select_contrast(self,image,criteria=10000,new_min=-1,new_max=-1):
         """Selects a smaller contrast band. The selection criteria is TODO to be refined.
 
+        Works on single images as well as (T, Y, X) stacks, the band being selected from the whole stack.
+
         Args:
             image (numpy.ndarray): image to process
             criteria (int,optional): intensity selection criteria. Defaults to 10000. TODO to be refined
@@ -18,25 +72,76 @@ class ContrastAdjustment:
             int : minimum intensity of new image
             int : maximum intensity of new image
         """
+        if new_min == -1 or new_max == -1:
+            new_min,new_max = self.band(self.histogram(image),image.size,criteria,new_min,new_max)
+
+        # Pixels are shifted down by new_min in the image's own type and capped to new_max+1
+        new_image = np.subtract(image,new_min,dtype=image.dtype)
+        cap = new_max+1
+        if np.issubdtype(image.dtype,np.integer):
+            cap = min(cap,np.iinfo(image.dtype).max)
+        new_image[~(new_image < cap)] = cap
+
+        return new_image,new_min,new_max
+
+    def select_contrast_frames(self,stack,criteria=10000):
+        """Applies select_contrast to each frame of a (T, Y, X) stack, each frame getting its own automatic band
+
+        Integer frames are counted together with a single np.bincount, only the band selection from each
+        frame's histogram is done frame by frame. Results are the same as select_contrast on every frame.
+
+        Args:
+            stack (numpy.ndarray): (T, Y, X) frames
+            criteria (int,optional): intensity selection criteria. Defaults to 10000
+
+        Returns:
+            numpy.ndarray: (T, Y, X) frames with new contrast
+            numpy.ndarray: (T,) minimum intensities of the new frames
+            numpy.ndarray: (T,) maximum intensities of the new frames
+        """
+        n = stack.shape[0]
+        flat = stack.reshape(n,-1)
+        low = int(flat.min()) if flat.size else 0
+        span = int(flat.max())-low+1 if flat.size else 1
+        if np.issubdtype(stack.dtype,np.integer) and span < 2**24 and n*span < 2**28:
+            # Each frame offset into its own range of the counts
+            values = (flat.astype(np.int64)-low)+np.arange(n)[:,None]*span
+            counts = np.bincount(values.ravel(),minlength=n*span).reshape(n,span)
+            bands = [self.band(self.histogram_from_counts(counts[t],stack.dtype,low),flat.shape[1],criteria) for t in range(n)]
+        else:
+            bands = [self.band(self.histogram(frame),frame.size,criteria) for frame in stack]
+        new_mins,new_maxs = np.array(bands,dtype=np.int64).reshape(n,2).T
+
+        new_stack = np.subtract(stack,new_mins.astype(stack.dtype)[:,None,None],dtype=stack.dtype)
+        caps = new_maxs+1
+        if np.issubdtype(stack.dtype,np.integer):
+            caps = np.minimum(caps,np.iinfo(stack.dtype).max)
+        caps = caps.astype(stack.dtype)[:,None,None]
+        new_stack = np.where(new_stack < caps,new_stack,caps)
+
+        return new_stack,new_mins,new_maxs
+
+if __name__ == '__main__':
+    # Benchmark against the former per-pixel implementation, checking results are identical
+    import time
+
+    def select_contrast_loop(image,criteria=10000,new_min=-1,new_max=-1):
         if new_min == -1 or new_max == -1:
             origin_min,origin_max = image.min(),image.max()
             histogram,bin_edges = np.histogram(image,int(origin_max))
             criteria = image.size/criteria
-            
             if new_min == -1:
                 new_min = 0
                 for i in range(new_min,new_max):
                     if histogram[i]>criteria:
                         new_min=i
                         break
-
             if new_max == -1:
                 new_max = histogram.size-1
                 for i in range(new_max,new_min,-1):
                     if histogram[i]>criteria:
                         new_max=i
                         break
-        
         new_image = np.copy(image)
         for i in range(new_image.shape[0]):
             for j in range(new_image.shape[1]):
@@ -45,6 +150,25 @@ class ContrastAdjustment:
                 if new_image[i][j] < new_min:
                     new_image[i][j] = new_min
                 new_image[i][j] = min(new_max+1,image[i][j]-new_min)
-                
+        return new_image,new_min,new_max
+
+    rng = np.random.default_rng(0)
+    adjuster = ContrastAdjustment()
+    image = rng.gamma(2.,300.,(512,512)).clip(0,4095).astype(np.uint16)
+    for kwargs in [{},{"new_min":200,"new_max":1500},{"new_max":2000},{"new_min":100}]:
+        start = time.perf_counter()
+        expected = select_contrast_loop(image,**kwargs)
+        loop_time = time.perf_counter()-start
+        start = time.perf_counter()
+        result = adjuster.select_contrast(image,**kwargs)
+        vectorized_time = time.perf_counter()-start
+        assert np.array_equal(expected[0],result[0]) and expected[0].dtype == result[0].dtype and expected[1:] == result[1:]
+        print(f"{kwargs} : loop {loop_time*1000:.1f} ms, vectorized {vectorized_time*1000:.2f} ms")
 
-        return new_image,new_min,new_max
\ No newline at end of file
+    # Signed frames wider than their type's maximum, counted with np.bincount after widening
+    for dtype,low,high in [(np.int8,-100,100),(np.int16,-30000,30000)]:
+        frame = rng.integers(low,high+1,(64,64)).astype(dtype)
+        expected = np.histogram(frame,int(frame.max()))[0]
+        assert np.array_equal(adjuster.histogram(frame),expected)
+        assert adjuster.band(expected,frame.size) == adjuster.select_contrast(frame)[1:]
+        print(f"{np.dtype(dtype).name} {low}..{high} : same histogram as np.histogram")
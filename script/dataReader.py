@@ -1,31 +1,287 @@
+import os
+import threading
+import numpy as np
 import tifffile
-import matplotlib.pyplot as plt
 from pathlib import Path
+from frameCache import FrameCache, Prefetcher
+from omeMetadata import OmeMetadata
+from frameStore import FrameStore, build_cache, default_dir
+
+# Whether the pages of the files checked so far are stored back to back, by path, size and modification time
+_contiguous = dict()
 
 class DataReader:
-    def __init__(self, file_path):
+    def __init__(self, file_path, mmap=True, cache_bytes=256*2**20, workers=None, use_store=True, transform=None, ome=None):
         """
         Initialize reader with an OME-TIFF file
-        Metadata are read from the first slice only
+        Metadata are read from the first slice only, other pages are only reached when their data is needed
+
+        Args:
+            file_path (str): path to the OME-TIFF file
+            mmap (bool,optional): memory-map the pixel data when the file is uncompressed and contiguous. True by default
+            cache_bytes (int,optional): size in bytes of the decoded frame cache used when the file isn't memory-mapped. Defaults to 256 MiB
+            workers (int,optional): number of threads decoding compressed pages concurrently. Defaults to the number of CPUs
+            use_store (bool,optional): read from the recording's chunked cache (see build_store) when there is an up to date one. True by default
+            transform (str,optional): read the corrected frames of the cache written by that correction (e.g. "motion", see
+                motionCorrection) instead of the file's frames. Defaults to None for the raw frames
+            ome (OmeMetadata,optional): description of the file's planes, for files whose own OME-XML doesn't hold it
+                (BinaryOnly files of a multi-file set, see multiFileReader). Defaults to None to read it from the file
         """
         self.file_path = file_path
+        self._options = dict(mmap=mmap,cache_bytes=cache_bytes,workers=workers,use_store=use_store,transform=transform,ome=ome)
         self.file = tifffile.TiffFile(file_path)
+        self.workers = workers or os.cpu_count() or 1
+        self._lock = threading.Lock() # The file handle is shared with the prefetch thread
+        self.cache = FrameCache(cache_bytes)
+        self._prefetcher = Prefetcher(self.cache,self._read_page)
+        self.ome = self._read_ome(0) if ome is None else ome
         self.metadata = dict()
         self.get_metadata(mode=True)
         #print(self.metadata)
+        # IFD of each (z, channel, time) plane stored in this file
+        self._planes = self.ome.ifd_index(os.path.basename(file_path))
+        if self.ome.names_files():
+            # The document describes a multi-file set : only the time points stored in this file are kept
+            self._planes = self._planes[:,:,(self._planes >= 0).any(axis=(0,1))]
+            self.metadata["SizeT"] = str(self._planes.shape[2])
+        # IFD of each (channel, time) plane, for the first Z plane
+        self._ifd_index = self._planes[0]
+        self.frame_shape,self.dtype = self.file.pages[0].shape,self.file.pages[0].dtype
         
         if int(self.metadata["SizeC"]) > 1:
             self.shape = (int(self.metadata["SizeC"]),int(self.metadata["SizeT"]),int(self.metadata["SizeX"]),int(self.metadata["SizeY"]))
         else:
             self.shape = (int(self.metadata["SizeT"]),int(self.metadata["SizeX"]),int(self.metadata["SizeY"]))
         #print(f"File ready with shape : {self.shape}")
+        # Memory-mapped when first used, see _mmap
+        self._memmap,self._memmap_checked = None,not mmap or transform is not None
+        self.store = FrameStore.find(file_path,default_dir(file_path,transform)) if use_store or transform else None
+        if transform is not None and self.store is None:
+            raise ValueError(f"No up to date {transform} cache for {file_path}")
 
     def close(self):
-        self.file.close()
+        self._prefetcher.stop()
+        self.cache.clear()
+        self._memmap,self._memmap_checked = None,True
+        with self._lock:
+            self.file.close()
+
+    def reopen(self, **options):
+        """Opens the same file again with the same options, but those given, for use from another thread"""
+        return DataReader(self.file_path,**dict(self._options,**options))
+
+    @property
+    def _mmap(self):
+        """Memory-mapped pages (see _open_memmap), None when the file is decoded
+
+        Opened when first needed rather than with the file, checking the layout of every page taking a while on
+        long recordings.
+        """
+        if not self._memmap_checked:
+            self._memmap,self._memmap_checked = self._open_memmap(),True
+        return self._memmap
+
+    def _open_memmap(self):
+        """Memory-maps all pages as a single (pages, Y, X) array
+
+        Only possible when the pages are uncompressed, single-sampled and stored back to back in the file.
+        The data offsets of every page are checked, from a second handle reading pages after the first as light
+        frames (the pages cached by self.file being left as they are) : a single page out of place, as with writers
+        interleaving IFDs with the image data or frames rewritten elsewhere, falls back on decoding. The result is
+        kept for the file as it is, readers opening it again (reopen) not checking it again.
+
+        Returns:
+            numpy.memmap: read-only array of all pages, or None if the file layout does not allow it
+        """
+        page_cnt = int(self._planes.max())+1
+        first = self.file.pages[0]
+        if page_cnt < 1 or first.compression != 1 or first.samplesperpixel != 1 or len(first.shape) != 2 or not first.is_contiguous:
+            return None
+        offset = first.dataoffsets[0]
+        if offset + page_cnt*first.nbytes > self.file.filehandle.size:
+            return None
+        stat = os.stat(self.file_path)
+        stamp = (os.path.abspath(self.file_path),stat.st_size,stat.st_mtime_ns,page_cnt)
+        if stamp not in _contiguous:
+            _contiguous[stamp] = page_cnt == 1 or self._pages_contiguous(page_cnt,offset,first.nbytes)
+        if not _contiguous[stamp]:
+            return None
+        dtype = np.dtype(first.dtype).newbyteorder(self.file.byteorder)
+        return np.memmap(self.file_path,dtype=dtype,mode='r',offset=offset,shape=(page_cnt,)+first.shape)
+
+    def _pages_contiguous(self, page_cnt, offset, nbytes):
+        """Whether the first page_cnt pages are stored back to back from offset, nbytes each"""
+        with tifffile.TiffFile(self.file_path) as tif:
+            tif.pages.useframes = True
+            try:
+                pages = [tif.pages[i] for i in range(page_cnt)]
+            except IndexError:
+                return False
+            offsets = np.concatenate([page.dataoffsets for page in pages]).astype(np.int64)
+            counts = np.concatenate([page.databytecounts for page in pages]).astype(np.int64)
+        return offsets[0] == offset and counts.sum() == page_cnt*nbytes and bool((offsets[1:] == offsets[:-1]+counts[:-1]).all())
+
+    @property
+    def is_memmapped(self):
+        """Whether slices are served as views into a memory-mapped file"""
+        return self._mmap is not None
+
+    def as_array(self):
+        """Get the whole recording as a (C, T, Y, X) array
+
+        When the file is memory-mapped and its pages follow a regular channel/time layout (any DimensionOrder)
+        this is a read-only view and no pixel data is copied.
+        Otherwise (compressed files) all pages are decoded into a new array.
+        """
+        index = self._stored(self._ifd_index)
+        if self._mmap is not None:
+            base = int(index[0,0])
+            step_c = int(index[1,0]-index[0,0]) if index.shape[0] > 1 else 0
+            step_t = int(index[0,1]-index[0,0]) if index.shape[1] > 1 else 0
+            c,t = np.indices(index.shape)
+            if (index == base+c*step_c+t*step_t).all():
+                frame_stride = self._mmap.strides[0]
+                return np.lib.stride_tricks.as_strided(self._mmap[base:],shape=index.shape+self._mmap.shape[1:],
+                                                       strides=(step_c*frame_stride,step_t*frame_stride)+self._mmap.strides[1:],
+                                                       writeable=False)
+            return self._mmap[index]
+        array = np.empty(index.shape+self.frame_shape,dtype=self.dtype)
+        for c in range(index.shape[0]):
+            self.read_frames(c,out=array[c])
+        return array
+
+    def page_index(self, channel=0, z_slice=0):
+        """Returns the index of the page (IFD) holding the specified image, as given by the OME-XML TiffData blocks
+
+        Raises:
+            IndexError: when no TiffData block stores the image in this file
+        """
+        return int(self._stored(self._ifd_index[channel,z_slice]))
+
+    def _stored(self, ifds):
+        """Returns ifds, taken from the IFD index, after checking that they are all stored in the file"""
+        if (np.asarray(ifds) < 0).any():
+            raise IndexError(f"Planes requested from {self.file_path} aren't stored in it, no TiffData block maps them to a page")
+        return ifds
+
+    def locate(self, channel=0, z_slice=0):
+        """Returns the file and page (IFD) holding the specified image"""
+        return self.file_path,self.page_index(channel,z_slice)
+
+    def _read_page(self, channel, z_slice):
+        """Decodes a page from the file, bypassing the cache"""
+        with self._lock:
+            frame = self.file.pages[self.page_index(channel,z_slice)].asarray()
+        frame.flags.writeable = False # Cached frames are shared between callers
+        return frame
+
+    @property
+    def levels(self):
+        """Downsampling factors frames can be read at, 1 being full resolution"""
+        return [1] if self.store is None else self.store.levels
+
+    def level_for_size(self, width, height):
+        """Returns the coarsest available level whose frames still cover width x height pixels"""
+        fitting = [level for level in self.levels if self.frame_shape[1]//level >= width and self.frame_shape[0]//level >= height]
+        return max(fitting,default=1)
+
+    def _from_store(self):
+        """Whether full resolution frames are read from the store rather than from the TIFF file
+
+        Compressed stores are slower to read at random than the file's pages, so only their pyramid levels are used,
+        unless the store holds corrected frames.
+        """
+        return self.store is not None and (self.store.transform is not None or (self._mmap is None and not self.store.compressed))
+
+    def build_store(self, **kwargs):
+        """Converts the recording into a chunked cache next to the file and reads from it from now on
 
-    def get_slice(self, channel=0, z_slice=0):
-        """Get specified image from the file"""
-        return self.file.pages[channel*int(self.metadata["SizeT"])+z_slice].asarray()
+        Args:
+            kwargs: options of frameStore.build_cache (chunk_frames, levels, compress)
+        """
+        if self.store is not None and self.store.transform is not None:
+            raise ValueError(f"Frames are read from the {self.store.transform} cache, not from the file")
+        self.store = None
+        self.store = build_cache(self,**kwargs)
+        return self.store
+
+    def get_slice(self, channel=0, z_slice=0, level=1):
+        """Get specified image from the file as a read-only array
+
+        Memory-mapped files return a view, other files are decoded once and kept in the frame cache.
+
+        Args:
+            channel (int,optional): Defaults to the first channel
+            z_slice (int,optional): Defaults to the first image
+            level (int,optional): downsampling factor, one of self.levels. Defaults to 1 for full resolution
+        """
+        if level != 1:
+            if level not in self.levels:
+                raise ValueError(f"Level {level} not available, build a store with it first")
+            return self.store.get_slice(channel,z_slice,level)
+        if self._from_store():
+            return self.store.get_slice(channel,z_slice)
+        if self._mmap is not None:
+            return self._mmap[self.page_index(channel,z_slice)]
+        frame = self.cache.get((channel,z_slice))
+        if frame is None:
+            frame = self._read_page(channel,z_slice)
+            self.cache.put((channel,z_slice),frame)
+        return frame
+
+    def _read_ifds(self, ifds, out):
+        """Reads the pages ifds into out, decoding compressed pages on self.workers threads"""
+        if self._mmap is not None:
+            np.take(self._mmap,ifds,axis=0,out=out)
+            return out
+        with self._lock:
+            if len(ifds) == 1:
+                self.file.pages[int(ifds[0])].asarray(out=out[0])
+            elif len(ifds) > 1:
+                self.file.asarray(key=[int(i) for i in ifds],out=out,maxworkers=self.workers)
+        return out
+
+    def read_frames(self, channel=0, start=0, stop=None, out=None):
+        """Reads a range of frames of a channel into a single array
+
+        Compressed pages are decoded concurrently, straight into the output array.
+        Frames are in time order with the file's data type, as with get_slice.
+
+        Args:
+            channel (int,optional): channel to read. Defaults to the first one
+            start (int,optional): first frame. Defaults to 0
+            stop (int,optional): frame to stop before. Defaults to the end of the channel
+            out (numpy.ndarray,optional): (n, Y, X) array to write into. Allocated by default
+
+        Returns:
+            numpy.ndarray: (n, Y, X) array of frames
+        """
+        ifds = self._stored(self._ifd_index[channel][start:stop])
+        if out is None:
+            out = np.empty((ifds.size,)+self.frame_shape,dtype=self.dtype)
+        if self._from_store():
+            return self.store.read_frames(channel,start,start+ifds.size,out)
+        return self._read_ifds(ifds,out)
+
+    def prefetch(self, channel=0, z_slice=0, step=1, count=16):
+        """Reads the frames following z_slice into the cache from a background thread
+
+        Frames wrap around the end of the channel like playback does. Nothing is done for memory-mapped files.
+
+        Args:
+            channel (int,optional): channel being played. Defaults to the first one
+            z_slice (int,optional): frame currently displayed. Defaults to 0
+            step (int,optional): playback direction and stride. Defaults to 1
+            count (int,optional): number of frames to read ahead. Defaults to 16
+        """
+        size_t = int(self.metadata["SizeT"])
+        self.prefetch_frames(channel,[(z_slice+k*step)%size_t for k in range(1,count+1)])
+
+    def prefetch_frames(self, channel, frames):
+        """Reads the given frames of a channel into the cache from a background thread, in order"""
+        if self._mmap is not None or self._from_store():
+            return
+        self._prefetcher.request([(channel,t) for t in frames])
     
     def get_all_slices(self,channel=-1):
         """Get all slices, or all in a single channel
@@ -33,14 +289,57 @@ class DataReader:
         Args:
             channel (int,optional): Channel to get slices from. -1 by default to get all images in the file
         """
-        if(channel==-1):
-            return [page.asarray() for page in self.file.pages]
+        if self._mmap is not None:
+            return list(self._mmap) if channel == -1 else [self._mmap[i] for i in self._stored(self._ifd_index[channel])]
+        if(channel==-1 and not self._from_store()):
+            ifds = np.sort(self._planes[self._planes >= 0])
+            return list(self._read_ifds(ifds,np.empty((ifds.size,)+self.frame_shape,dtype=self.dtype)))
+        elif(channel==-1):
+            return [frame for c in range(self._ifd_index.shape[0]) for frame in self.read_frames(c)]
         else:
-            return [page.asarray() for page in self.file.pages[channel*int(self.metadata["SizeT"]):(channel+1)*int(self.metadata["SizeT"])]]
+            return list(self.read_frames(channel))
+
+    def iter_chunks(self, channel=0, chunk_frames=64, start=0, stop=None):
+        """Iterates over a channel in contiguous blocks of frames
+
+        Blocks are written into a single buffer reused from one block to the next (or are views into the
+        memory-mapped file when the channel is stored contiguously), so memory use stays at one block.
+        Copy a block if it is needed after the next iteration.
+
+        Args:
+            channel (int,optional): channel to read. Defaults to the first one
+            chunk_frames (int,optional): number of frames per block. Defaults to 64
+            start (int,optional): first frame. Defaults to 0
+            stop (int,optional): frame to stop before. Defaults to the end of the channel
+
+        Yields:
+            int: index of the first frame of the block
+            numpy.ndarray: (n, Y, X) block of frames, n <= chunk_frames
+        """
+        index = self._ifd_index[channel]
+        stop = index.size if stop is None else min(stop,index.size)
+        self._stored(index[start:stop])
+        contiguous = self._mmap is not None and (np.diff(index[start:stop]) == 1).all()
+        buffer = None
+        for t in range(start,stop,chunk_frames):
+            ifds = index[t:min(t+chunk_frames,stop)]
+            if contiguous:
+                yield t,self._mmap[ifds[0]:ifds[-1]+1]
+                continue
+            if buffer is None:
+                buffer = np.empty((min(chunk_frames,stop-start),)+self.frame_shape,dtype=self.dtype)
+            yield t,self.read_frames(channel,t,t+ifds.size,out=buffer[:ifds.size])
+
+    def _read_ome(self, slice):
+        """Parses the OME-XML block of a slice"""
+        with self._lock:
+            tags = self.file.pages[slice].tags
+        return OmeMetadata.from_xml(tags["ImageDescription"].value)
 
     def get_metadata(self,slice=0,keys=["TimeIncrement","PhysicalSizeX","PhysicalSizeY","SizeC","SizeT","SizeX","SizeY","Type","Channels"],mode=False):
         """
         Gets metadata information from the OME-XML block from a slice in the file. All metadata is read as strings.
+        The parsed block of the first slice is also available in full as self.ome.
         Default metadata retrieved are :
             * TimeIncrement : time in seconds between images
             * PhysicalSizeX : width in μm of pixels
@@ -51,31 +350,15 @@ class DataReader:
             * SizeY : number of pixels vertically
             * Type : type of data stored in each pixel
             * Channels : names of channels
+        Keys absent from the OME-XML block are left out of the result.
 
         Args:
             slice (int,optional): Index of the slice to load metadata from. Index to use is when all channels are flattened one ofter the other. 0 by default
             keys (list of string,optional): list of keys to parse in OME-XML metadata
             mode (bool,optional) : whether read metadata should be saved in the DataReader instance. True by default
         """
-        tags = self.file.pages[slice].tags
-        image_desc = tags["ImageDescription"].value
-        pixel_info = image_desc[image_desc.find("<Pixels"):image_desc.find("</Pixels>")]
-        channel_info = image_desc[image_desc.find("<Channel"):image_desc.find("<TiffData/>")]
-        def parse(str,key,pre=' ',end='"'):
-            """Parse str for the string after key and before (and including) end"""
-            tmp = str[str.find(pre+key+'=')+len(key)+3:]
-            tmp = tmp[:tmp.find(end)]
-            return tmp
-        res = dict()
-        #Fill the dictionary with metadata from keys
-        for key in keys:
-            res[key] = parse(pixel_info,key)
-        if "Channels" in keys:
-            #Fill channel data with names (usually color codes)
-            res["Channels"] = []
-            for i in range(int(res["SizeC"])):
-                res["Channels"].append(parse(channel_info,"Name"))
-                channel_info = channel_info[channel_info.find("/>")+2:]
+        ome = self.ome if slice == 0 else self._read_ome(slice)
+        res = ome.to_dict(keys)
         if mode:
             self.metadata = dict(res)
         return res
@@ -101,6 +384,7 @@ class DataReader:
 
     def plot_image(self, channel=0, z_slice=0):
         """Plot specified image with a color bar"""
+        import matplotlib.pyplot as plt
         image_2d = self.get_slice(channel, z_slice)
         plt.figure(figsize=(8, 6))
         plt.imshow(image_2d, cmap="gray", aspect="auto")
@@ -112,6 +396,7 @@ class DataReader:
 
     def plot_intensity_profile(self, channel=0, z_slice=0):
         """Plot intensity profile on median row of specified slice"""
+        import matplotlib.pyplot as plt
         image_2d = self.get_slice(channel, z_slice)
         y_row = image_2d.shape[0] // 2  # Ligne médiane
         intensity_profile = image_2d[y_row, :]
@@ -127,6 +412,7 @@ class DataReader:
 
     def plot_histogram(self, channel=0, z_slice=0):
         """Plot histogram of specified slice"""
+        import matplotlib.pyplot as plt
         image_2d = self.get_slice(channel, z_slice)
 
         plt.figure(figsize=(8, 6))
@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+from PyQt6.QtGui import QImage
+
+class DisplayRenderer:
+    def __init__(self):
+        """
+        Converts frames to 8 bits grayscale images for display through a lookup table
+
+        The table maps every possible pixel value (65536 for 16 bits frames) to its display value. It is only
+        rebuilt when the display range changes, and frames are converted in a single pass into a reused buffer.
+        """
+        self._lut = None
+        self._lut_key = None
+        self._buffer = None
+
+    def lut(self, low, high, dtype=np.uint16):
+        """Returns the table mapping low (and below) to 0 and high (and above) to 255, linearly in between"""
+        dtype = np.dtype(dtype)
+        key = (int(low),int(high),dtype)
+        if key != self._lut_key:
+            values = np.arange(2**(8*dtype.itemsize),dtype=np.float32)
+            scale = 255/max(int(high)-int(low),1)
+            self._lut = np.clip(np.rint((values-int(low))*scale),0,255).astype(np.uint8)
+            self._lut_key = key
+        return self._lut
+
+    def render(self, image, low=None, high=None, out=None):
+        """Converts a frame to 8 bits for display
+
+        Args:
+            image (numpy.ndarray): (Y, X) frame
+            low (int,optional): value displayed black. Defaults to the frame minimum
+            high (int,optional): value displayed white. Defaults to the frame maximum
+            out (numpy.ndarray,optional): (Y, X) uint8 array to write into. Defaults to the renderer buffer,
+                overwritten by the next call
+
+        Returns:
+            numpy.ndarray: (Y, X) uint8 frame
+        """
+        if out is None:
+            if self._buffer is None or self._buffer.shape != image.shape:
+                self._buffer = np.empty(image.shape,dtype=np.uint8)
+            out = self._buffer
+        if low is None or high is None:
+            frame_min,frame_max,_,_ = cv2.minMaxLoc(image)
+            low = frame_min if low is None else low
+            high = frame_max if high is None else high
+        if image.dtype in (np.uint8,np.uint16):
+            np.take(self.lut(low,high,image.dtype),image,out=out,mode="clip")
+        else:
+            # No table for other pixel types, scale them directly
+            scaled = (image.astype(np.float32)-low)*(255/max(high-low,1e-12))
+            np.rint(np.clip(scaled,0,255),out=scaled)
+            out[...] = scaled
+        return out
+
+    def to_qimage(self, image, low=None, high=None):
+        """Renders a frame as a grayscale QImage, see render
+
+        The QImage shares the renderer buffer : convert it (QPixmap.fromImage) before rendering the next frame.
+        """
+        gray = self.render(image,low,high)
+        height,width = gray.shape
+        return QImage(gray.data,width,height,gray.strides[0],QImage.Format.Format_Grayscale8)
@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+
+class FrameCache:
+    def __init__(self, max_bytes=256*2**20):
+        """
+        Bounded cache of decoded frames with least recently used eviction
+
+        Args:
+            max_bytes (int,optional): maximum total size of cached frames in bytes. Defaults to 256 MiB
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._frames
+
+    def __len__(self):
+        with self._lock:
+            return len(self._frames)
+
+    def get(self, key):
+        """Returns the frame stored under key and marks it as recently used, or None if it isn't cached"""
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        """Stores a frame, evicting the least recently used ones until the cache fits in max_bytes
+
+        Frames larger than the whole cache are not stored.
+        """
+        if frame.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._frames:
+                self.nbytes -= self._frames[key].nbytes
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            self.nbytes += frame.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+class Prefetcher:
+    def __init__(self, cache, load):
+        """
+        Fills a FrameCache from a background thread
+
+        Only the latest request is served : a new request interrupts the one being read.
+
+        Args:
+            cache (FrameCache): cache to fill
+            load (function): called with the unpacked key to read a frame that isn't cached yet
+        """
+        self.cache = cache
+        self.load = load
+        self._request = None
+        self._running = True
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def request(self, keys):
+        """Asks for the frames under keys to be read in order, replacing any pending request"""
+        with self._condition:
+            if not self._running:
+                return
+            self._request = list(keys)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def stop(self):
+        """Stops the background thread, waiting for the frame being read to finish"""
+        with self._condition:
+            self._running = False
+            self._request = None
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and self._request is None:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                keys,self._request = self._request,None
+            for key in keys:
+                with self._condition:
+                    if self._request is not None or not self._running:
+                        break
+                if key not in self.cache:
+                    try:
+                        self.cache.put(key,self.load(*key))
+                    except Exception:
+                        # Left for the next synchronous read to report
+                        break
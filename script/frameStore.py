@@ -0,0 +1,188 @@
+import os
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+from frameCache import FrameCache
+
+SIDECAR = "metadata.json"
+VERSION = 1
+
+def default_dir(file_path, transform=None):
+    """Cache directory used for a recording : next to it, with a .cache suffix (.<transform>.cache for corrected frames)"""
+    return Path(str(file_path)+("" if transform is None else "."+transform)+".cache")
+
+def downsample(block, factor):
+    """Averages (n, Y, X) frames over factor x factor pixel blocks, dropping incomplete blocks on the edges"""
+    n,y,x = block.shape
+    y,x = y//factor*factor,x//factor*factor
+    res = block[:,:y,:x].reshape(n,y//factor,factor,x//factor,factor).mean(axis=(2,4),dtype=np.float32)
+    if np.issubdtype(block.dtype,np.integer):
+        res = np.rint(res)
+    return res.astype(block.dtype)
+
+def _source_stamp(source):
+    stat = os.stat(source)
+    return {"path":str(source),"size":stat.st_size,"mtime_ns":stat.st_mtime_ns}
+
+class FrameStoreWriter:
+    def __init__(self, cache_dir, source, shape, dtype, metadata, chunk_frames=64, levels=(1,2,4), compress=True, transform=None):
+        """
+        Writes a recording into a chunked cache directory, with downsampled pyramid levels
+
+        Chunks are written into a sibling <cache_dir>.tmp directory, swapped in place of cache_dir by close : a cache
+        being read meanwhile (by the displayed reader) is not removed under it while the new one is written.
+
+        Layout :
+            * metadata.json : shape, data type, chunking, levels, source file stamp and recording metadata, written last
+            * level<f>/c<channel>/t<first frame>.npz (or .npy) : (n, Y/f, X/f) frames, n <= chunk_frames
+
+        Args:
+            cache_dir (str): cache directory, replaced if it exists once the cache is complete
+            source (str): recording the cache stands for. Its size and modification time invalidate the cache
+            shape (tuple of int): (C, T, Y, X) shape of the recording
+            dtype (numpy.dtype): pixel data type
+            metadata (dict): recording metadata saved in the sidecar (DataReader.metadata)
+            chunk_frames (int,optional): frames per chunk file. Defaults to 64
+            levels (tuple of int,optional): downsampling factors to store (positive integers), 1 being full resolution. Defaults to (1,2,4)
+            compress (bool,optional): store chunks as compressed .npz rather than memory-mappable .npy. Defaults to True
+            transform (str,optional): name of the correction applied to the frames (e.g. "motion"), None for raw frames
+        """
+        if any(not isinstance(level,(int,np.integer)) or level < 1 for level in levels):
+            raise ValueError(f"Levels must be positive integers, not {levels}")
+        self.cache_dir = Path(cache_dir)
+        self.temporary_dir = self.cache_dir.with_name(self.cache_dir.name+".tmp")
+        if self.temporary_dir.exists():
+            # Left by an interrupted build
+            shutil.rmtree(self.temporary_dir)
+        self.levels = sorted(set(levels)|{1})
+        self.chunk_frames = chunk_frames
+        self.compress = compress
+        self.info = {"version":VERSION,"source":_source_stamp(source),"shape":list(shape),"dtype":np.dtype(dtype).str,
+                     "chunk_frames":chunk_frames,"levels":self.levels,"compress":compress,"transform":transform,"metadata":metadata}
+        for level in self.levels:
+            for c in range(shape[0]):
+                (self.temporary_dir/f"level{level}"/f"c{c}").mkdir(parents=True)
+
+    def write(self, channel, start, block):
+        """Writes (n, Y, X) full resolution frames of a channel starting at frame start, which must begin a chunk"""
+        if start%self.chunk_frames:
+            raise ValueError(f"Blocks must start on a multiple of {self.chunk_frames} frames")
+        for t in range(0,block.shape[0],self.chunk_frames):
+            full = block[t:t+self.chunk_frames]
+            for level in self.levels:
+                # From full resolution each time, levels not having to divide each other
+                chunk = full if level == 1 else downsample(full,level)
+                path = self.temporary_dir/f"level{level}"/f"c{channel}"/f"t{start+t:08d}"
+                if self.compress:
+                    np.savez_compressed(path.with_suffix(".npz"),frames=chunk)
+                else:
+                    np.save(path.with_suffix(".npy"),np.ascontiguousarray(chunk))
+
+    def close(self):
+        """Writes the sidecar, marking the cache as complete, and swaps the cache in place of the previous one"""
+        with open(self.temporary_dir/SIDECAR,"w") as file:
+            json.dump(self.info,file,indent=4)
+        previous = self.cache_dir.with_name(self.cache_dir.name+".old")
+        if previous.exists():
+            shutil.rmtree(previous)
+        if self.cache_dir.exists():
+            # os.replace does not replace a non-empty directory, the previous cache is moved aside first
+            os.replace(self.cache_dir,previous)
+        os.replace(self.temporary_dir,self.cache_dir)
+        # Chunks of the previous cache memory-mapped by a reader cannot be removed on Windows, they are on the next build
+        shutil.rmtree(previous,ignore_errors=True)
+        return FrameStore(self.cache_dir)
+
+class FrameStore:
+    def __init__(self, cache_dir, cache_bytes=128*2**20):
+        """
+        Reads a cache directory written by FrameStoreWriter
+
+        Args:
+            cache_dir (str): cache directory
+            cache_bytes (int,optional): size in bytes of the decoded chunk cache. Defaults to 128 MiB
+        """
+        self.cache_dir = Path(cache_dir)
+        with open(self.cache_dir/SIDECAR) as file:
+            self.info = json.load(file)
+        self.shape = tuple(self.info["shape"])
+        self.dtype = np.dtype(self.info["dtype"])
+        self.chunk_frames = self.info["chunk_frames"]
+        self.levels = self.info["levels"]
+        self.compressed = self.info["compress"]
+        self.transform = self.info["transform"]
+        self.metadata = self.info["metadata"]
+        self._chunks = FrameCache(cache_bytes)
+
+    @classmethod
+    def find(cls, file_path, cache_dir=None):
+        """Opens the cache of a recording if there is a complete one matching the file as it is now, None otherwise"""
+        cache_dir = default_dir(file_path) if cache_dir is None else Path(cache_dir)
+        try:
+            with open(cache_dir/SIDECAR) as file:
+                info = json.load(file)
+        except (OSError,ValueError):
+            return None
+        stamp = _source_stamp(file_path)
+        if info.get("version") != VERSION or (info["source"]["size"],info["source"]["mtime_ns"]) != (stamp["size"],stamp["mtime_ns"]):
+            return None
+        return cls(cache_dir)
+
+    def level_shape(self, level):
+        """(Y, X) shape of frames at a pyramid level"""
+        return (self.shape[2]//level,self.shape[3]//level)
+
+    def _chunk(self, level, channel, index):
+        key = (level,channel,index)
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            path = self.cache_dir/f"level{level}"/f"c{channel}"/f"t{index*self.chunk_frames:08d}"
+            if self.compressed:
+                with np.load(path.with_suffix(".npz")) as data:
+                    chunk = data["frames"]
+            else:
+                chunk = np.load(path.with_suffix(".npy"),mmap_mode="r")
+            self._chunks.put(key,chunk)
+        return chunk
+
+    def get_slice(self, channel=0, z_slice=0, level=1):
+        """Get a frame at a pyramid level"""
+        if level not in self.levels:
+            raise ValueError(f"Level {level} not in cache levels {self.levels}")
+        return self._chunk(level,channel,z_slice//self.chunk_frames)[z_slice%self.chunk_frames]
+
+    def read_frames(self, channel=0, start=0, stop=None, out=None, level=1):
+        """Reads a range of frames of a channel at a pyramid level into a single (n, Y, X) array"""
+        stop = self.shape[1] if stop is None else min(stop,self.shape[1])
+        if out is None:
+            out = np.empty((max(0,stop-start),)+self.level_shape(level),dtype=self.dtype)
+        t = start
+        while t < stop:
+            index = t//self.chunk_frames
+            n = min(stop,(index+1)*self.chunk_frames)-t
+            out[t-start:t-start+n] = self._chunk(level,channel,index)[t%self.chunk_frames:t%self.chunk_frames+n]
+            t += n
+        return out
+
+def build_cache(reader, cache_dir=None, chunk_frames=64, levels=(1,2,4), compress=True):
+    """Converts a recording into a chunked cache with pyramid levels, in a single pass over the file
+
+    Args:
+        reader (DataReader): recording to convert
+        cache_dir (str,optional): cache directory. Defaults to the file path with a .cache suffix
+        chunk_frames (int,optional): frames per chunk file. Defaults to 64
+        levels (tuple of int,optional): downsampling factors to store. Defaults to (1,2,4)
+        compress (bool,optional): compress chunks. Defaults to True
+
+    Returns:
+        FrameStore: the written cache
+    """
+    cache_dir = default_dir(reader.file_path) if cache_dir is None else cache_dir
+    size_c,size_t = int(reader.metadata["SizeC"]),int(reader.metadata["SizeT"])
+    writer = FrameStoreWriter(cache_dir,reader.file_path,(size_c,size_t)+reader.frame_shape,reader.dtype,reader.metadata,
+                              chunk_frames,levels,compress)
+    for c in range(size_c):
+        for t,block in reader.iter_chunks(c,chunk_frames):
+            writer.write(c,t,block)
+    return writer.close()
@@ -0,0 +1,40 @@
+import sys
+import subprocess
+from pathlib import Path
+
+def import_times(module="GUI"):
+    """Imports a module in a new interpreter with python -X importtime
+
+    Args:
+        module (str,optional): module to import, from this directory. Defaults to GUI
+
+    Returns:
+        list of (float, float, str): cumulative and own import time in seconds and name of every module imported, in import order
+    """
+    res = subprocess.run([sys.executable,"-X","importtime","-c",f"import {module}"],cwd=Path(__file__).parent,capture_output=True,text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed : {res.stderr.strip().splitlines()[-1]}")
+    times = []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own,cumulative,name = line[len("import time:"):].split("|")
+        times.append((int(cumulative)/1e6,int(own)/1e6,name.strip()))
+    return times
+
+def report(module="GUI", top=15):
+    """Returns a text report of the top modules by cumulative import time, and the total time in seconds taken to import a module"""
+    times = import_times(module)
+    total = next(cumulative for cumulative,_,name in reversed(times) if name == module)
+    lines = [f"Importing {module} : {total:.3f} s","cumulative       self  module"]
+    for cumulative,own,name in sorted(times,reverse=True)[:top]:
+        lines.append(f"{cumulative:8.3f} s {own:8.3f} s  {name}")
+    return "\n".join(lines),total
+
+if __name__ == '__main__':
+    # python importReport.py [module] [maximum seconds] : exits with an error when the import takes longer
+    module = sys.argv[1] if len(sys.argv) > 1 else "GUI"
+    text,total = report(module)
+    print(text)
+    if len(sys.argv) > 2 and total > float(sys.argv[2]):
+        sys.exit(f"Importing {module} takes {total:.3f} s, more than {sys.argv[2]} s")
@@ -0,0 +1,109 @@
+import threading
+import numpy as np
+from contrastAdjustment import ContrastAdjustment
+
+class IntensityHistograms:
+    def __init__(self, reader, frame_bins=512, chunk_frames=64):
+        """
+        Histograms of every frame and of every channel of a recording, computed once
+
+        Per channel the counts are kept for every intensity value, per frame in frame_bins bins of equal width
+        over the range given by the OME SignificantBits (or the pixel type). Counts are filled by build or
+        build_async, frames becoming available as they are read.
+
+        Args:
+            reader (DataReader): recording with unsigned integer pixels (up to 16 bits)
+            frame_bins (int,optional): number of bins of the per-frame histograms. Defaults to 512
+            chunk_frames (int,optional): number of frames counted together. Defaults to 64
+        """
+        self.reader = reader
+        self.dtype = np.dtype(reader.dtype)
+        if self.dtype.kind != "u" or self.dtype.itemsize > 2:
+            raise ValueError(f"Histograms need 8 or 16 bits unsigned pixels, not {self.dtype}")
+        bits = int(reader.ome.attributes.get("SignificantBits",8*self.dtype.itemsize))
+        self.value_count = 2**min(bits,8*self.dtype.itemsize)
+        self.frame_bins = min(frame_bins,self.value_count)
+        self.bin_width = self.value_count//self.frame_bins
+        self.chunk_frames = chunk_frames
+        size_c,size_t = int(reader.metadata["SizeC"]),int(reader.metadata["SizeT"])
+        self.frame_counts = np.zeros((size_c,size_t,self.frame_bins),dtype=np.uint32)
+        self.channel_counts = np.zeros((size_c,2**(8*self.dtype.itemsize)),dtype=np.uint64)
+        self.frame_done = np.zeros((size_c,size_t),dtype=bool)
+        self.channel_done = np.zeros(size_c,dtype=bool)
+        self._cancel = threading.Event()
+        self._thread = None
+        self.contrast_adjuster = ContrastAdjustment()
+
+    def build(self, channels=None):
+        """Reads the recording and fills the histograms
+
+        Runs from a copy of the reader so that it can be called from another thread.
+
+        Args:
+            channels (list of int,optional): channels to count, in this order. Defaults to all of them
+        """
+        channels = range(self.frame_counts.shape[0]) if channels is None else channels
+        reader = self.reader.reopen()
+        try:
+            for c in channels:
+                for t,block in reader.iter_chunks(c,self.chunk_frames):
+                    if self._cancel.is_set():
+                        return
+                    n = block.shape[0]
+                    flat = block.reshape(n,-1)
+                    # One bincount for the whole block, each frame offset into its own range of bins
+                    bins = np.minimum(flat//self.bin_width,self.frame_bins-1).astype(np.intp)
+                    bins += np.arange(n)[:,None]*self.frame_bins
+                    self.frame_counts[c,t:t+n] = np.bincount(bins.ravel(),minlength=n*self.frame_bins).reshape(n,self.frame_bins)
+                    self.channel_counts[c] += np.bincount(flat.ravel(),minlength=self.channel_counts.shape[1]).astype(np.uint64)
+                    self.frame_done[c,t:t+n] = True
+                self.channel_done[c] = True
+        finally:
+            reader.close()
+
+    def build_async(self, channels=None):
+        """Runs build on a background thread"""
+        self._thread = threading.Thread(target=self.build,args=(channels,),daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        """Stops a running build"""
+        self._cancel.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def frame_histogram(self, channel=0, z_slice=0):
+        """Returns the left edges and counts of the bins of a frame's histogram, or None if it hasn't been counted yet"""
+        if not self.frame_done[channel,z_slice]:
+            return None
+        return np.arange(self.frame_bins)*self.bin_width,self.frame_counts[channel,z_slice]
+
+    def cumulative(self, channel=0, z_slice=None):
+        """Returns the cumulative histogram of a frame (in frame bins) or of a whole channel (z_slice None, per intensity)"""
+        counts = self.channel_counts[channel] if z_slice is None else self.frame_counts[channel,z_slice]
+        return np.cumsum(counts,dtype=np.uint64)
+
+    def percentile(self, q, channel=0, z_slice=None):
+        """Returns the intensity below which q percent of the pixels of a frame or of a whole channel (z_slice None) are
+
+        Frame percentiles are given to the bin width, channel percentiles to the intensity.
+        """
+        ready = self.channel_done[channel] if z_slice is None else self.frame_done[channel,z_slice]
+        if not ready:
+            raise ValueError("Histogram not computed yet")
+        cumulative = self.cumulative(channel,z_slice)
+        index = int(np.searchsorted(cumulative,q/100*cumulative[-1],side="left"))
+        return index if z_slice is None else index*self.bin_width
+
+    def contrast_bounds(self, channel=0, criteria=10000):
+        """Automatic contrast band of a whole channel, the same as ContrastAdjustment.select_contrast on all its frames
+
+        Returns:
+            int : lower bound of the band
+            int : upper bound of the band
+        """
+        if not self.channel_done[channel]:
+            raise ValueError("Histogram not computed yet")
+        counts = self.channel_counts[channel]
+        histogram = self.contrast_adjuster.histogram_from_counts(counts,self.dtype)
+        return self.contrast_adjuster.band(histogram,int(counts.sum()),criteria)
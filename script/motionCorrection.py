@@ -0,0 +1,201 @@
+from pathlib import Path
+import numpy as np
+from scipy import fft
+from scipy.ndimage import shift as ndi_shift
+from frameStore import FrameStoreWriter, default_dir
+
+TRANSFORM = "motion"
+
+class MotionCorrection:
+    def __init__(self, template_frames=200, max_shift=None, smooth_sigma=1.5, chunk_frames=64, workers=-1):
+        """
+        Rigid motion correction by phase correlation against a template
+
+        Shifts of a whole block of frames are estimated at once from the 2D FFTs of the frames, tapered by a Hann
+        window so that their borders don't correlate. The phase correlation is smoothed by a gaussian so that its
+        peak can be refined to sub-pixel precision with a parabola. Frames are moved by bilinear interpolation,
+        repeating edges.
+
+        Args:
+            template_frames (int,optional): number of frames, evenly spread over the recording, averaged into the template. Defaults to 200
+            max_shift (int,optional): largest displacement searched, in pixels. Defaults to None for half the frame
+            smooth_sigma (float,optional): standard deviation in pixels of the gaussian smoothing the correlation. Defaults to 1.5
+            chunk_frames (int,optional): number of frames registered and written together. Defaults to 64
+            workers (int,optional): number of threads computing the FFTs. Defaults to -1 for all CPUs
+        """
+        self.template_frames = template_frames
+        self.max_shift = max_shift
+        self.smooth_sigma = smooth_sigma
+        self.chunk_frames = chunk_frames
+        self.workers = workers
+
+    def template(self, reader, channel=0):
+        """Mean of template_frames frames evenly spread over a channel"""
+        size_t = int(reader.metadata["SizeT"])
+        frames = np.unique(np.linspace(0,size_t-1,min(self.template_frames,size_t)).astype(int))
+        template = np.zeros(reader.frame_shape,dtype=np.float64)
+        for t in frames:
+            template += reader.get_slice(channel,int(t))
+        return (template/frames.size).astype(np.float32)
+
+    def _fft(self, frames):
+        frames = frames.astype(np.float32)
+        frames -= frames.mean(axis=(1,2),keepdims=True)
+        frames *= np.outer(np.hanning(frames.shape[1]),np.hanning(frames.shape[2])).astype(np.float32)
+        return fft.rfft2(frames,workers=self.workers)
+
+    def register(self, block, template):
+        """Estimates the shifts aligning each frame of a (n, Y, X) block on the template
+
+        Returns:
+            numpy.ndarray: (n, 2) shifts (dy, dx) to apply to the frames, in pixels
+        """
+        n,size_y,size_x = block.shape
+        # Normalized cross-power spectrum, peaking at the displacement of each frame from the template
+        cross = self._fft(block)*np.conj(self._fft(template[None]))
+        cross /= np.abs(cross)+1e-12
+        frequencies = fft.fftfreq(size_y)[:,None]**2+fft.rfftfreq(size_x)[None,:]**2
+        cross *= np.exp(-2*np.pi**2*self.smooth_sigma**2*frequencies).astype(np.float32)
+        correlation = fft.irfft2(cross,s=(size_y,size_x),workers=self.workers)
+        dy = (np.arange(size_y)+size_y//2)%size_y-size_y//2
+        dx = (np.arange(size_x)+size_x//2)%size_x-size_x//2
+        if self.max_shift is not None:
+            outside = (np.abs(dy)[:,None] > self.max_shift) | (np.abs(dx)[None,:] > self.max_shift)
+            correlation[:,outside] = -np.inf
+        peak = correlation.reshape(n,-1).argmax(axis=1)
+        py,px = np.divmod(peak,size_x)
+        frames = np.arange(n)
+        shifts = np.empty((n,2))
+        for axis,(p,size,along) in enumerate([(py,size_y,dy),(px,size_x,dx)]):
+            before,after = [py,px],[py,px]
+            before[axis],after[axis] = (p-1)%size,(p+1)%size
+            c_before,c_peak,c_after = correlation[frames,before[0],before[1]],correlation[frames,py,px],correlation[frames,after[0],after[1]]
+            with np.errstate(invalid="ignore",divide="ignore"):
+                offset = 0.5*(c_before-c_after)/(c_before-2*c_peak+c_after)
+            offset = np.where(np.isfinite(offset),np.clip(offset,-0.5,0.5),0)
+            shifts[:,axis] = -(along[p]+offset)
+        return shifts
+
+    def estimate_shifts(self, reader, channel=0, template=None):
+        """Registers every frame of a channel, in blocks of chunk_frames frames
+
+        Args:
+            reader (DataReader): recording to register
+            channel (int,optional): channel the shifts are estimated on. Defaults to the first one
+            template (numpy.ndarray,optional): (Y, X) reference frame. Defaults to the template of the channel
+
+        Returns:
+            numpy.ndarray: (T, 2) shifts (dy, dx) to apply to the frames, in pixels
+        """
+        template = self.template(reader,channel) if template is None else template
+        shifts = np.zeros((int(reader.metadata["SizeT"]),2))
+        for t,block in reader.iter_chunks(channel,self.chunk_frames):
+            shifts[t:t+len(block)] = self.register(block,template)
+        return shifts
+
+    def apply(self, block, shifts, out=None):
+        """Moves each frame of a (n, Y, X) block by its (dy, dx) shift, keeping the block's data type
+
+        out may be the block itself.
+        """
+        out = np.empty_like(block) if out is None else out
+        moved = np.empty(block.shape[1:],dtype=np.float32)
+        integer = np.issubdtype(block.dtype,np.integer)
+        for frame,shift,res in zip(block,shifts,out):
+            if not shift.any():
+                res[...] = frame
+                continue
+            ndi_shift(frame.astype(np.float32,copy=False),shift,output=moved,order=1,mode="nearest")
+            if integer:
+                np.rint(moved,out=moved)
+            res[...] = moved
+        return out
+
+    def correct(self, reader, channel=0):
+        """Registers a channel and returns a reader applying the shifts to every channel on the fly"""
+        return CorrectedReader(reader,self.estimate_shifts(reader,channel),self)
+
+    def write_store(self, reader, shifts, cache_dir=None, levels=(1,2,4), compress=False):
+        """Writes the corrected frames of every channel into a chunked cache, in a single pass over the recording
+
+        The cache is read back with DataReader(file_path, transform="motion"). The shifts are saved next to
+        the frames as shifts.npy.
+
+        Args:
+            reader (DataReader): single file recording to correct
+            shifts (numpy.ndarray): (T, 2) shifts returned by estimate_shifts
+            cache_dir (str,optional): cache directory. Defaults to the file path with a .motion.cache suffix
+            levels (tuple of int,optional): downsampling factors to store. Defaults to (1,2,4)
+            compress (bool,optional): compress chunks. Defaults to False so that frames are memory-mapped
+
+        Returns:
+            FrameStore: the written cache
+        """
+        cache_dir = default_dir(reader.file_path,TRANSFORM) if cache_dir is None else Path(cache_dir)
+        size_c,size_t = int(reader.metadata["SizeC"]),int(reader.metadata["SizeT"])
+        writer = FrameStoreWriter(cache_dir,reader.file_path,(size_c,size_t)+reader.frame_shape,reader.dtype,reader.metadata,
+                                  self.chunk_frames,levels,compress,TRANSFORM)
+        np.save(writer.temporary_dir/"shifts.npy",shifts)
+        buffer = np.empty((min(self.chunk_frames,size_t),)+reader.frame_shape,dtype=reader.dtype)
+        for c in range(size_c):
+            for t,block in reader.iter_chunks(c,self.chunk_frames):
+                writer.write(c,t,self.apply(block,shifts[t:t+len(block)],out=buffer[:len(block)]))
+        return writer.close()
+
+class CorrectedReader:
+    def __init__(self, reader, shifts, correction=None):
+        """
+        Applies motion correction shifts to the frames of another reader as they are read
+
+        Reads like a DataReader : attributes and methods not defined here are those of the wrapped reader.
+
+        Args:
+            reader (DataReader): raw recording (DataReader or MultiFileReader)
+            shifts (numpy.ndarray): (T, 2) shifts (dy, dx) to apply to the frames of every channel
+            correction (MotionCorrection,optional): correction moving the frames. Defaults to a new one
+        """
+        self.reader = reader
+        self.shifts = shifts
+        self.correction = MotionCorrection() if correction is None else correction
+
+    def __getattr__(self, name):
+        return getattr(self.reader,name)
+
+    @property
+    def is_memmapped(self):
+        return False
+
+    def reopen(self, **options):
+        """Opens the same recording again with the same shifts, and the options of the wrapped reader but those given, for use from another thread"""
+        return CorrectedReader(self.reader.reopen(**options),self.shifts,self.correction)
+
+    def get_slice(self, channel=0, z_slice=0, level=1):
+        """Get specified corrected image, at a pyramid level"""
+        frame = self.reader.get_slice(channel,z_slice,level)
+        return self.correction.apply(frame[None],self.shifts[z_slice:z_slice+1]/level)[0]
+
+    def read_frames(self, channel=0, start=0, stop=None, out=None):
+        """Reads a range of corrected frames of a channel into a single array, see DataReader.read_frames"""
+        frames = self.reader.read_frames(channel,start,stop,out)
+        return self.correction.apply(frames,self.shifts[start:start+len(frames)],out=frames)
+
+    def iter_chunks(self, channel=0, chunk_frames=64, start=0, stop=None):
+        """Iterates over a channel in blocks of corrected frames, written into a single reused buffer"""
+        buffer = None
+        for t,block in self.reader.iter_chunks(channel,chunk_frames,start,stop):
+            if buffer is None:
+                buffer = np.empty(block.shape,dtype=block.dtype)
+            yield t,self.correction.apply(block,self.shifts[t:t+len(block)],out=buffer[:len(block)])
+
+    def get_all_slices(self, channel=-1):
+        """Get all corrected slices of a channel, or of every channel one after the other with -1"""
+        channels = range(int(self.metadata["SizeC"])) if channel == -1 else [channel]
+        return [frame for c in channels for frame in self.read_frames(c)]
+
+    def as_array(self):
+        """Get the whole corrected recording as a (C, T, Y, X) array"""
+        size_c,size_t = int(self.metadata["SizeC"]),int(self.metadata["SizeT"])
+        array = np.empty((size_c,size_t)+self.frame_shape,dtype=self.dtype)
+        for c in range(size_c):
+            self.read_frames(c,out=array[c])
+        return array
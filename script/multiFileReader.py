@@ -0,0 +1,229 @@
+import os
+import threading
+import dataclasses
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+import numpy as np
+import tifffile
+from dataReader import DataReader
+from omeMetadata import OmeMetadata
+from frameStore import FrameStore
+
+class MultiFileReader:
+    def __init__(self, file_paths, max_open=4, **reader_options):
+        """
+        Presents several OME-TIFF files of one session as a single recording, one after the other along time
+
+        Only the OME-XML of each file is read here. The frames of each file are those the TiffData blocks of the
+        first complete OME-XML place in it (by <UUID> FileName), or, when blocks don't name files, its pages divided
+        by the planes of a time point. Files are opened as DataReader when their frames are first needed and at most
+        max_open of them stay open, the least recently used one not being read from being closed first.
+
+        Args:
+            file_paths (list of str): files in acquisition order
+            max_open (int,optional): maximum number of files kept open. Defaults to 4
+            reader_options: keyword arguments passed on to each DataReader (mmap, cache_bytes, workers, use_store)
+        """
+        if not file_paths:
+            raise ValueError("No file given")
+        self.file_paths = list(file_paths)
+        self.file_path = self.file_paths[0]
+        self.max_open = max(1,max_open)
+        self.reader_options = reader_options
+        self._readers = OrderedDict()
+        self._users = Counter() # Reads in progress on each open file, which mustn't be closed meanwhile
+        self._lock = threading.Lock()
+
+        omes = []
+        for path in self.file_paths:
+            with tifffile.TiffFile(path) as tif:
+                try:
+                    omes.append(OmeMetadata.from_xml(tif.pages[0].tags["ImageDescription"].value))
+                except ValueError:
+                    omes.append(None) # BinaryOnly file, described by another file of the set
+        master = next((ome for ome in omes if ome is not None),None)
+        if master is None:
+            raise ValueError(f"No OME-XML describing the pixels in {self.file_path} or the following files")
+        for path,ome in zip(self.file_paths,omes):
+            if ome is not None and (master.size_c != ome.size_c or (master.size_x,master.size_y) != (ome.size_x,ome.size_y) or master.pixel_type != ome.pixel_type):
+                raise ValueError(f"{path} does not match the channels, size or pixel type of {self.file_path}")
+
+        # Description of the planes of each file, passed on to its DataReader
+        self._omes = []
+        for path,ome in zip(self.file_paths,omes):
+            if master.names_files():
+                self._omes.append(master)
+                continue
+            with tifffile.TiffFile(path) as tif:
+                size_t = len(tif.pages)//(master.size_c*master.size_z)
+            own = master if ome is None else ome
+            self._omes.append(own if own.size_t == size_t else dataclasses.replace(own,size_t=size_t,attributes=dict(own.attributes,SizeT=str(size_t))))
+        sizes = []
+        for path,ome in zip(self.file_paths,self._omes):
+            if ome.names_files():
+                sizes.append(int((ome.ifd_index(os.path.basename(path)) >= 0).any(axis=(0,1)).sum()))
+            else:
+                sizes.append(ome.size_t)
+        # First frame of each file on the global time axis, followed by the total
+        self.offsets = np.cumsum([0]+sizes)
+        self.ome = dataclasses.replace(master,size_t=int(self.offsets[-1]),tiff_data=[],attributes=dict(master.attributes,SizeT=str(self.offsets[-1])))
+        self.metadata = self.ome.to_dict(["TimeIncrement","PhysicalSizeX","PhysicalSizeY","SizeC","SizeT","SizeX","SizeY","Type","Channels"])
+        self.metadata["Files"] = str(len(self.file_paths))
+
+        self._find_levels()
+        with self._reader(0) as first:
+            self.frame_shape,self.dtype = first.frame_shape,first.dtype
+        if self.ome.size_c > 1:
+            self.shape = (self.ome.size_c,self.ome.size_t,self.ome.size_x,self.ome.size_y)
+        else:
+            self.shape = (self.ome.size_t,self.ome.size_x,self.ome.size_y)
+
+    def close(self):
+        with self._lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+            self._users.clear()
+
+    def reopen(self, **options):
+        """Opens the same files again with the same options, but those given (see DataReader), for use from another thread"""
+        return MultiFileReader(self.file_paths,self.max_open,**dict(self.reader_options,**options))
+
+    @contextmanager
+    def _reader(self, index):
+        """Context giving the DataReader of file index, opened if needed
+
+        The file stays open until the context exits, other threads only closing the least recently used files
+        nobody is reading from.
+        """
+        with self._lock:
+            reader = self._readers.get(index)
+            if reader is None:
+                reader = DataReader(self.file_paths[index],ome=self._omes[index],**self.reader_options)
+                self._readers[index] = reader
+            self._readers.move_to_end(index)
+            self._users[index] += 1
+        try:
+            yield reader
+        finally:
+            with self._lock:
+                self._users[index] -= 1
+                self._evict()
+
+    def _evict(self):
+        """Closes the least recently used files over max_open that aren't being read, with the lock held"""
+        for index in list(self._readers):
+            if len(self._readers) <= self.max_open:
+                break
+            if self._users[index] <= 0:
+                self._readers.pop(index).close()
+                del self._users[index]
+
+    def _file_of(self, z_slice):
+        """Returns the index of the file holding a global frame and the frame's index in that file"""
+        if not 0 <= z_slice < self.offsets[-1]:
+            raise IndexError(f"Frame {z_slice} out of range for {self.offsets[-1]} frames")
+        index = int(np.searchsorted(self.offsets,z_slice,side="right"))-1
+        return index,z_slice-int(self.offsets[index])
+
+    @property
+    def is_memmapped(self):
+        return False
+
+    def _find_levels(self):
+        """Keeps the pyramid levels present in the stores of every file"""
+        levels = {1}
+        if self.reader_options.get("use_store",True):
+            stores = [FrameStore.find(path) for path in self.file_paths]
+            if all(stores):
+                levels = set.intersection(*[set(store.levels) for store in stores])
+        self.levels = sorted(levels)
+
+    def level_for_size(self, width, height):
+        """Returns the coarsest available level whose frames still cover width x height pixels"""
+        fitting = [level for level in self.levels if self.frame_shape[1]//level >= width and self.frame_shape[0]//level >= height]
+        return max(fitting,default=1)
+
+    def build_store(self, **kwargs):
+        """Converts every file into its own chunked cache, see DataReader.build_store"""
+        for index in range(len(self.file_paths)):
+            with self._reader(index) as reader:
+                reader.build_store(**kwargs)
+        self._find_levels()
+
+    def locate(self, channel=0, z_slice=0):
+        """Returns the file and page (IFD) holding the specified image"""
+        index,local = self._file_of(z_slice)
+        with self._reader(index) as reader:
+            return reader.locate(channel,local)
+
+    def get_slice(self, channel=0, z_slice=0, level=1):
+        """Get specified image of the session, z_slice being counted from the start of the first file"""
+        index,local = self._file_of(z_slice)
+        with self._reader(index) as reader:
+            return reader.get_slice(channel,local,level)
+
+    def read_frames(self, channel=0, start=0, stop=None, out=None):
+        """Reads a range of frames of a channel into a single array, across file boundaries
+
+        Args:
+            channel (int,optional): channel to read. Defaults to the first one
+            start (int,optional): first frame. Defaults to 0
+            stop (int,optional): frame to stop before. Defaults to the end of the session
+            out (numpy.ndarray,optional): (n, Y, X) array to write into. Allocated by default
+
+        Returns:
+            numpy.ndarray: (n, Y, X) array of frames
+        """
+        stop = int(self.offsets[-1]) if stop is None else min(stop,int(self.offsets[-1]))
+        if out is None:
+            out = np.empty((max(0,stop-start),)+self.frame_shape,dtype=self.dtype)
+        t = start
+        while t < stop:
+            index,local = self._file_of(t)
+            n = min(stop,int(self.offsets[index+1]))-t
+            with self._reader(index) as reader:
+                reader.read_frames(channel,local,local+n,out=out[t-start:t-start+n])
+            t += n
+        return out
+
+    def iter_chunks(self, channel=0, chunk_frames=64, start=0, stop=None):
+        """Iterates over a channel of the session in contiguous blocks of frames, see DataReader.iter_chunks
+
+        Blocks may span two files. They are written into a single reused buffer.
+        """
+        stop = int(self.offsets[-1]) if stop is None else min(stop,int(self.offsets[-1]))
+        buffer = np.empty((min(chunk_frames,max(0,stop-start)),)+self.frame_shape,dtype=self.dtype)
+        for t in range(start,stop,chunk_frames):
+            n = min(chunk_frames,stop-t)
+            yield t,self.read_frames(channel,t,t+n,out=buffer[:n])
+
+    def get_all_slices(self, channel=-1):
+        """Get all slices of a channel across files, or of every channel one after the other with -1"""
+        channels = range(self.ome.size_c) if channel == -1 else [channel]
+        return [frame for c in channels for frame in self.read_frames(c)]
+
+    def as_array(self):
+        """Get the whole session as a (C, T, Y, X) array, decoded into memory"""
+        array = np.empty((self.ome.size_c,self.ome.size_t)+self.frame_shape,dtype=self.dtype)
+        for c in range(self.ome.size_c):
+            self.read_frames(c,out=array[c])
+        return array
+
+    def prefetch(self, channel=0, z_slice=0, step=1, count=16):
+        """Reads the frames following z_slice in the background, see DataReader.prefetch
+
+        Read-ahead continues into the next file, which is opened ahead of time.
+        """
+        frames = OrderedDict()
+        for k in range(1,count+1):
+            index,local = self._file_of((z_slice+k*step)%int(self.offsets[-1]))
+            frames.setdefault(index,[]).append(local)
+        for index in frames:
+            with self._reader(index) as reader:
+                reader.prefetch_frames(channel,frames[index])
+
+    def channel_from_name(self, name):
+        """Returns the channel index corresponding to the input channel name, or -1 if it isn't in the files"""
+        names = self.metadata["Channels"]
+        return names.index(name) if name in names else -1
@@ -0,0 +1,122 @@
+import sys
+from pathlib import Path
+import numpy as np
+
+WEIGHTS_PATH = Path(__file__).parent/"model_unet.npz"
+
+def export_weights(model_path, weights_path=WEIGHTS_PATH):
+    """Saves the weights of the Keras U-Net (build_simple_unet in PR.ipynb) as plain arrays, for NumpyUnet
+
+    Convolutions are saved in the order they are built as conv<i>_kernel / conv<i>_bias, transposed
+    convolutions as up<i>_kernel / up<i>_bias.
+
+    Args:
+        model_path (str): Keras model file
+        weights_path (str,optional): .npz file to write. Defaults to model_unet.npz next to this file
+    """
+    from keras.models import load_model
+    model = load_model(model_path)
+    arrays = dict()
+    convs,ups = 0,0
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if kind == "Conv2D":
+            name,convs = f"conv{convs}",convs+1
+        elif kind == "Conv2DTranspose":
+            name,ups = f"up{ups}",ups+1
+        else:
+            continue
+        kernel,bias = layer.get_weights()
+        arrays[name+"_kernel"],arrays[name+"_bias"] = kernel.astype(np.float32),bias.astype(np.float32)
+    if (convs,ups) != (8,3):
+        raise ValueError(f"{model_path} is not the U-Net of build_simple_unet ({convs} convolutions, {ups} transposed convolutions)")
+    np.savez(weights_path,**arrays)
+
+class NumpyUnet:
+    def __init__(self, weights_path=WEIGHTS_PATH):
+        """
+        The U-Net of build_simple_unet (PR.ipynb) run with NumPy, from weights saved by export_weights
+
+        Predicts like the Keras model (predict_on_batch) without importing TensorFlow. Frames sizes must be multiples of 8.
+
+        Args:
+            weights_path (str,optional): .npz file written by export_weights. Defaults to model_unet.npz next to this file
+        """
+        with np.load(weights_path) as data:
+            self.weights = {key:data[key] for key in data.files}
+
+    def _conv(self, x, index, activation="relu"):
+        """'same' convolution of (n, H, W, C) features, summed over the kernel offsets so that no patch array is built"""
+        kernel,bias = self.weights[f"conv{index}_kernel"],self.weights[f"conv{index}_bias"]
+        size_y,size_x = kernel.shape[:2]
+        n,height,width,_ = x.shape
+        if size_y > 1 or size_x > 1:
+            x = np.pad(x,((0,0),(size_y//2,(size_y-1)//2),(size_x//2,(size_x-1)//2),(0,0)))
+        out = np.empty((n,height,width,kernel.shape[3]),dtype=np.float32)
+        out[...] = bias
+        for dy in range(size_y):
+            for dx in range(size_x):
+                out += x[:,dy:dy+height,dx:dx+width] @ kernel[dy,dx]
+        if activation == "relu":
+            np.maximum(out,0,out=out)
+        elif activation == "sigmoid":
+            # 1/(1+exp(-x)) in place, exp(-x) reaching inf for very negative x giving 0
+            np.negative(out,out=out)
+            with np.errstate(over="ignore"):
+                np.exp(out,out=out)
+            out += 1
+            np.reciprocal(out,out=out)
+        return out
+
+    def _pool(self, x):
+        """2x2 'same' max pooling"""
+        n,height,width,channels = x.shape
+        if height%2 or width%2:
+            x = np.pad(x,((0,0),(0,height%2),(0,width%2),(0,0)),constant_values=-np.inf)
+        return x.reshape(n,x.shape[1]//2,2,x.shape[2]//2,2,channels).max(axis=(2,4))
+
+    def _up(self, x, index):
+        """2x2 transposed convolution with stride 2 : each input pixel becomes a 2x2 block"""
+        kernel,bias = self.weights[f"up{index}_kernel"],self.weights[f"up{index}_bias"] # kernel (2, 2, out, in)
+        n,height,width,_ = x.shape
+        out = np.tensordot(x,kernel.transpose(3,0,1,2),axes=1) # (n, H, W, 2, 2, out)
+        out = out.transpose(0,1,3,2,4,5).reshape(n,2*height,2*width,kernel.shape[2])
+        out += bias
+        return out
+
+    def predict_on_batch(self, batch):
+        """Predicts (n, H, W, 1) probability maps of (n, H, W, 1) normalized frames"""
+        x = np.asarray(batch,dtype=np.float32)
+        c0 = self._conv(x,0)
+        c1 = self._conv(self._pool(c0),1)
+        c2 = self._conv(self._pool(c1),2)
+        c3 = self._conv(self._pool(c2),3)
+        c4 = self._conv(np.concatenate([self._up(c3,0),c2],axis=-1),4)
+        c5 = self._conv(np.concatenate([self._up(c4,1),c1],axis=-1),5)
+        c6 = self._conv(np.concatenate([self._up(c5,2),c0],axis=-1),6)
+        return self._conv(c6,7,"sigmoid")
+
+def validate(model_path, weights_path=WEIGHTS_PATH, frames=None, atol=1e-4):
+    """Compares NumpyUnet with the Keras model on frames (random ones by default)
+
+    Returns:
+        float: largest absolute difference between the probabilities of both models
+
+    Raises:
+        ValueError: if the difference is over atol
+    """
+    from keras.models import load_model
+    if frames is None:
+        frames = np.random.default_rng(0).random((2,360,360,1),dtype=np.float32)
+    expected = np.asarray(load_model(model_path).predict_on_batch(frames))
+    difference = float(np.abs(NumpyUnet(weights_path).predict_on_batch(frames)-expected).max())
+    if difference > atol:
+        raise ValueError(f"NumPy U-Net differs from Keras by {difference}, more than {atol}")
+    return difference
+
+if __name__ == '__main__':
+    # python numpyUnet.py [model_unet.keras] [model_unet.npz] : exports the weights and checks the NumPy model against Keras
+    model_path = sys.argv[1] if len(sys.argv) > 1 else Path(__file__).parent/"model_unet.keras"
+    weights_path = sys.argv[2] if len(sys.argv) > 2 else WEIGHTS_PATH
+    export_weights(model_path,weights_path)
+    print(f"Weights saved to {weights_path}, largest difference with Keras : {validate(model_path,weights_path)}")
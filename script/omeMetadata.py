@@ -0,0 +1,153 @@
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+import numpy as np
+
+@dataclass
+class Channel:
+    id: str = ""
+    name: str = ""
+
+@dataclass
+class Plane:
+    the_z: int = 0
+    the_c: int = 0
+    the_t: int = 0
+    delta_t: float = None
+    exposure_time: float = None
+
+@dataclass
+class TiffData:
+    ifd: int = 0
+    first_z: int = 0
+    first_c: int = 0
+    first_t: int = 0
+    plane_count: int = None # None when the block covers all remaining planes
+    file_name: str = None # File holding the planes when given by a <UUID> child, None for the document's own file
+
+@dataclass
+class OmeMetadata:
+    """Pixels description of the first image of an OME-XML document"""
+    dimension_order: str = "XYZCT"
+    size_x: int = 1
+    size_y: int = 1
+    size_z: int = 1
+    size_c: int = 1
+    size_t: int = 1
+    pixel_type: str = ""
+    physical_size_x: float = None
+    physical_size_y: float = None
+    physical_size_z: float = None
+    time_increment: float = None
+    channels: list = field(default_factory=list)
+    planes: list = field(default_factory=list)
+    tiff_data: list = field(default_factory=list)
+    attributes: dict = field(default_factory=dict) # Raw <Pixels> attributes, as strings
+
+    @classmethod
+    def from_xml(cls, xml):
+        """Parses an OME-XML document, whatever its schema namespace and attribute order
+
+        Args:
+            xml (str): content of the ImageDescription tag
+
+        Returns:
+            OmeMetadata: description of the first <Pixels> element
+        """
+        root = ET.fromstring(xml.encode() if isinstance(xml,str) else xml)
+        pixels = next((el for el in root.iter() if _local(el.tag) == "Pixels"),None)
+        if pixels is None:
+            raise ValueError("No <Pixels> element in OME-XML metadata")
+        attrib = dict(pixels.attrib)
+        res = cls(
+            dimension_order = attrib.get("DimensionOrder","XYZCT"),
+            size_x = int(attrib.get("SizeX",1)),
+            size_y = int(attrib.get("SizeY",1)),
+            size_z = int(attrib.get("SizeZ",1)),
+            size_c = int(attrib.get("SizeC",1)),
+            size_t = int(attrib.get("SizeT",1)),
+            pixel_type = attrib.get("Type",""),
+            physical_size_x = _float(attrib.get("PhysicalSizeX")),
+            physical_size_y = _float(attrib.get("PhysicalSizeY")),
+            physical_size_z = _float(attrib.get("PhysicalSizeZ")),
+            time_increment = _float(attrib.get("TimeIncrement")),
+            attributes = attrib
+        )
+        for el in pixels:
+            tag = _local(el.tag)
+            if tag == "Channel":
+                res.channels.append(Channel(el.get("ID",""),el.get("Name","")))
+            elif tag == "Plane":
+                res.planes.append(Plane(int(el.get("TheZ",0)),int(el.get("TheC",0)),int(el.get("TheT",0)),
+                                        _float(el.get("DeltaT")),_float(el.get("ExposureTime"))))
+            elif tag == "TiffData":
+                # A bare <TiffData/> covers every plane, otherwise PlaneCount defaults to 1
+                count = el.get("PlaneCount",1 if el.attrib else None)
+                uuid = next((child for child in el if _local(child.tag) == "UUID"),None)
+                res.tiff_data.append(TiffData(int(el.get("IFD",0)),int(el.get("FirstZ",0)),int(el.get("FirstC",0)),
+                                              int(el.get("FirstT",0)),None if count is None else int(count),
+                                              None if uuid is None else uuid.get("FileName")))
+        return res
+
+    @property
+    def plane_count(self):
+        return self.size_z*self.size_c*self.size_t
+
+    def plane_number(self, z, c, t):
+        """Position of plane (z, c, t) when planes are ordered by DimensionOrder"""
+        sizes = {"Z":self.size_z,"C":self.size_c,"T":self.size_t}
+        coords = {"Z":z,"C":c,"T":t}
+        number,stride = 0,1
+        for dim in self.dimension_order[2:]:
+            number += coords[dim]*stride
+            stride *= sizes[dim]
+        return number
+
+    def names_files(self):
+        """Whether TiffData blocks place planes in files given by name, the document describing a multi-file set"""
+        return any(block.file_name is not None for block in self.tiff_data)
+
+    def ifd_index(self, file_name=None):
+        """Builds the IFD holding each plane from the TiffData blocks, without touching the file
+
+        Without TiffData, IFDs are assumed to follow DimensionOrder from the first one.
+        Blocks naming a file other than file_name (a multi-file set) are left out, their planes being stored elsewhere.
+
+        Args:
+            file_name (str,optional): base name of the file the IFDs are looked up in. Defaults to None for the
+                document's own file only
+
+        Returns:
+            numpy.ndarray: (Z, C, T) array of IFD numbers, -1 where a plane isn't stored
+        """
+        z,c,t = np.meshgrid(np.arange(self.size_z),np.arange(self.size_c),np.arange(self.size_t),indexing="ij")
+        numbers = self.plane_number(z,c,t)
+        if not self.tiff_data:
+            return numbers
+        plane_to_ifd = np.full(self.plane_count,-1,dtype=np.int64)
+        for block in self.tiff_data:
+            if block.file_name is not None and block.file_name != file_name:
+                continue
+            start = self.plane_number(block.first_z,block.first_c,block.first_t)
+            count = self.plane_count-start if block.plane_count is None else min(block.plane_count,self.plane_count-start)
+            plane_to_ifd[start:start+count] = np.arange(block.ifd,block.ifd+count)
+        return plane_to_ifd[numbers]
+
+    def to_dict(self, keys):
+        """Returns the requested <Pixels> attributes as strings, plus the list of channel names under "Channels"
+
+        Attributes missing from the document are left out.
+        """
+        res = dict()
+        for key in keys:
+            if key == "Channels":
+                res[key] = [channel.name for channel in self.channels]
+            elif key in self.attributes:
+                res[key] = self.attributes[key]
+        return res
+
+def _local(tag):
+    """Strips the namespace from an ElementTree tag"""
+    return tag.rsplit("}",1)[-1]
+
+def _float(value):
+    return None if value is None else float(value)
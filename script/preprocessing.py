@@ -1,7 +1,7 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from skimage.transform import resize
+from concurrent.futures import ProcessPoolExecutor
 from scipy.ndimage import gaussian_filter
+from scipy import sparse
 from contrastAdjustment import ContrastAdjustment
 
 class Preprocessor:
@@ -9,6 +9,7 @@ class Preprocessor:
         """Initialise le préprocesseur avec un ajustement de contraste."""
         self.target_size = target_size
         self.contrast_adjuster = ContrastAdjustment()
+        self._resize_operators = {}
 
     def preprocess_image(self, image_2d, debug=True):
         """
@@ -34,6 +35,7 @@ class Preprocessor:
         image_normalized = (image_filtered - np.min(image_filtered)) / (np.max(image_filtered) - np.min(image_filtered) + 1e-8)
 
         # Redimensionnement
+        from skimage.transform import resize
         image_resized = resize(image_normalized, self.target_size, mode='constant', anti_aliasing=True)
         # if debug:
         #     self._plot_step(image_resized, "After Resizing")
@@ -49,8 +51,76 @@ class Preprocessor:
 
         return image_resized, mask
 
+    def preprocess_stack(self, stack, chunk_frames=64, workers=None):
+        """
+        Applique le prétraitement de preprocess_image à chaque image d'une pile (T, Y, X), en une fois :
+        - Ajustement du contraste (bande propre à chaque image)
+        - Filtrage Gaussien dans le plan des images
+        - Normalisation (0,1) de chaque image
+        - Redimensionnement de toute la pile
+        - Masque au 98e percentile de chaque image
+
+        Args:
+            stack (numpy.ndarray): (T, Y, X) images
+            chunk_frames (int,optional): nombre d'images traitées ensemble. Defaults to 64
+            workers (int,optional): nombre de processus entre lesquels répartir les blocs. Defaults to None (dans ce processus)
+
+        Returns:
+            numpy.ndarray: (T, H, W) images prétraitées, (H, W) étant target_size
+            numpy.ndarray: (T, H, W) masques
+        """
+        images = np.empty((stack.shape[0],)+tuple(self.target_size),dtype=np.float64)
+        masks = np.empty(images.shape,dtype=bool)
+        starts = range(0,stack.shape[0],chunk_frames)
+        chunks = (stack[t:t+chunk_frames] for t in starts)
+        if workers:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(self._preprocess_chunk,chunks))
+        else:
+            results = map(self._preprocess_chunk,chunks)
+        for t,(chunk_images,chunk_masks) in zip(starts,results):
+            images[t:t+len(chunk_images)] = chunk_images
+            masks[t:t+len(chunk_masks)] = chunk_masks
+        return images, masks
+
+    def _preprocess_chunk(self, stack):
+        """Prétraite un bloc (n, Y, X), mêmes étapes et mêmes résultats que preprocess_image sur chaque image"""
+        stack_adjusted, _, _ = self.contrast_adjuster.select_contrast_frames(stack)
+        # Pas de lissage le long du temps
+        stack_filtered = gaussian_filter(stack_adjusted, sigma=(0, 0.4, 0.4))
+        stack_min = stack_filtered.min(axis=(1, 2), keepdims=True)
+        stack_max = stack_filtered.max(axis=(1, 2), keepdims=True)
+        stack_normalized = (stack_filtered - stack_min) / (stack_max - stack_min + 1e-8)
+        stack_resized = self._resize_stack(stack_normalized)
+        threshold = np.percentile(stack_resized, 98, axis=(1, 2), keepdims=True)
+        return stack_resized, stack_resized > threshold
+
+    def _resize_operator(self, size, target):
+        """Matrice creuse (target, size) du redimensionnement de preprocess_image le long d'un axe
+
+        Le lissage anti-aliasing et l'interpolation linéaire de resize sont séparables et linéaires : l'opérateur
+        d'un axe s'obtient en redimensionnant l'identité le long de cet axe seulement.
+        """
+        key = (size,target)
+        if key not in self._resize_operators:
+            from skimage.transform import resize
+            self._resize_operators[key] = sparse.csr_matrix(resize(np.eye(size), (target, size), mode='constant', anti_aliasing=True))
+        return self._resize_operators[key]
+
+    def _resize_stack(self, stack):
+        """Redimensionne une pile (n, Y, X) de valeurs dans (0,1) à target_size, comme resize image par image (aux arrondis près)"""
+        n, size_y, size_x = stack.shape
+        target_y, target_x = self.target_size
+        resize_y = self._resize_operator(size_y, target_y)
+        resize_x = self._resize_operator(size_x, target_x)
+        # Axe Y sur toutes les images à la fois, puis axe X
+        stack_y = (resize_y @ stack.transpose(1, 0, 2).reshape(size_y, -1)).reshape(target_y, n, size_x)
+        stack_xy = resize_x @ stack_y.reshape(-1, size_x).T
+        return np.ascontiguousarray(stack_xy.reshape(target_x, target_y, n).transpose(2, 1, 0))
+
     def _plot_step(self, image, title):
         """Affiche chaque étape du traitement."""
+        import matplotlib.pyplot as plt
         plt.figure(figsize=(6, 6))
         plt.imshow(image, cmap="gray")
         plt.title(title)
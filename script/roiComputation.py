@@ -1,61 +1,283 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
 import numpy as np
 import cv2
 
+def _group_ranks(counts):
+    """Rank of every element within its group, for consecutive groups of counts elements : [0,1,..,counts[0]-1,0,1,..]"""
+    return np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts,counts)
+
+def contours_to_pixels(contours):
+    """Returns the pixels of every contour, by scanlines over all the contours at once
+        Pixels are the points (x,y) with non-negative coordinates inside or on the edge of the polygon,
+        as cv2.pointPolygonTest(contour,(x,y),False) >= 0
+
+    Args:
+        contours (3d array of int): array of contours, points being [x,y]
+
+    Returns:
+        list of (array of int, array of int): x and y of the pixels of each contour, sorted by x then y
+    """
+    points = [np.asarray(contour,dtype=np.int64).reshape(-1,2) for contour in contours]
+    if not points:
+        return []
+    sizes = np.array([len(p) for p in points])
+    roi = np.repeat(np.arange(len(points)),sizes)
+    start = np.concatenate(points) if sizes.sum() else np.zeros((0,2),dtype=np.int64)
+    #Each point is joined to the next one of its contour, the last one to the first one
+    following = np.arange(len(start))+1
+    following[np.cumsum(sizes)[sizes > 0]-1] = (np.cumsum(sizes)-sizes)[sizes > 0]
+    x0,y0 = start[:,0],start[:,1]
+    dx,dy = x0[following]-x0,y0[following]-y0
+
+    #Pixels on the edges : points of each edge with integer coordinates
+    steps = np.gcd(np.abs(dx),np.abs(dy))
+    edge = np.repeat(np.arange(len(start)),steps+1)
+    k = _group_ranks(steps+1)
+    step = np.maximum(steps,1)[edge]
+    edge_x,edge_y = x0[edge]+k*(dx[edge]//step),y0[edge]+k*(dy[edge]//step)
+    edge_roi = roi[edge]
+
+    #Inside pixels : on every row, between the 1st and 2nd crossing of the edges with the row, the 3rd and 4th...
+    #An edge crosses the rows from its lowest y included to its highest y excluded, horizontal edges none
+    low = np.minimum(y0,y0+dy)
+    counts = np.abs(dy)
+    edge = np.repeat(np.arange(len(start)),counts)
+    row = low[edge]+_group_ranks(counts)
+    cross = x0[edge]+(row-y0[edge])*dx[edge]/dy[edge] #Exact when it is an integer
+    order = np.lexsort((cross,row,roi[edge]))
+    row,cross,cross_roi = row[order],cross[order],roi[edge][order]
+    first,last = np.floor(cross[0::2]).astype(np.int64)+1,np.ceil(cross[1::2]).astype(np.int64)-1 #Crossings themselves are on edges
+    lengths = np.maximum(last-first+1,0)
+    inside_x = np.repeat(first,lengths)+_group_ranks(lengths)
+    inside_y = np.repeat(row[0::2],lengths)
+    inside_roi = np.repeat(cross_roi[0::2],lengths)
+
+    xs,ys,rois = np.concatenate([edge_x,inside_x]),np.concatenate([edge_y,inside_y]),np.concatenate([edge_roi,inside_roi])
+    keep = (xs >= 0) & (ys >= 0)
+    xs,ys,rois = xs[keep],ys[keep],rois[keep]
+    sizeX,sizeY = int(xs.max(initial=0))+1,int(ys.max(initial=0))+1
+    keys = np.unique((rois*sizeX+xs)*sizeY+ys)
+    rois,xs,ys = keys//(sizeX*sizeY),keys//sizeY%sizeX,keys%sizeY
+    bounds = np.searchsorted(rois,np.arange(len(points)+1))
+    return [(xs[a:b],ys[a:b]) for a,b in zip(bounds[:-1],bounds[1:])]
+
 def contours_to_masks(contours):
     """Returns the array of masks corresponding to input contours
-        Each mask is a tuple of its top left coordinates and a binary array
+        Each mask is a tuple of its top left coordinates and a binary array indexed [x-minX][y-minY]
 
     Args:
         contours (3d array of int): array of contours
     """
     masks = []
-    for contour in contours:
-        #Search for maximum coordinates
-        minX,maxX,minY,maxY = 0,0,0,0
-        for point in contour:
-            if point[0] < minX : minX = point[0]
-            if point[0] > maxX : maxX = point[0]
-            if point[1] < minY : minY = point[1]
-            if point[1] > maxY : maxY = point[1]
-        #Create the mask
-        mask = np.full((maxX-minX+1,maxY-minY+1),False)
-        #Fill the mask
-        for i in range(mask.shape[0]):
-            for j in range(mask.shape[1]):
-                mask[i][j] = (cv2.pointPolygonTest(contour,(i,j),False) >= 0)
+    for contour,(xs,ys) in zip(contours,contours_to_pixels(contours)):
+        points = np.asarray(contour,dtype=np.int64).reshape(-1,2)
+        #Bounding box of the contour, pixels with negative coordinates left out
+        minX,minY = max(int(points[:,0].min()),0),max(int(points[:,1].min()),0)
+        maxX,maxY = int(points[:,0].max()),int(points[:,1].max())
+        mask = np.full((max(maxX-minX+1,0),max(maxY-minY+1,0)),False)
+        mask[xs-minX,ys-minY] = True
         masks.append(((minX,minY),mask))
     return masks
 
-def compute_dff(reader,masks,channel=0):
+def masks_to_matrix(masks,shape):
+    """Returns the sparse (number of roi, Y*X) matrix summing the pixels of each mask over a flattened frame
+        As in compute_dff, mask pixel [i][j] reads the frame at [minX+i][minY+j], column (minX+i)*X+minY+j.
+
+    Args:
+        masks (list of mask): Masks delimiting ROIs
+        shape (tuple of int): (Y,X) shape of the frames
+
+    Raises:
+        IndexError: if a mask has pixels out of the frame, as indexing the frame with them would
+    """
+    from scipy import sparse
+    rows,columns = [],[]
+    for k,((minX,minY),mask) in enumerate(masks):
+        i,j = np.nonzero(mask)
+        i,j = i+minX,j+minY
+        if ((i < 0) | (i >= shape[0]) | (j < 0) | (j >= shape[1])).any():
+            raise IndexError(f"ROI {k} has pixels out of the {shape[0]}x{shape[1]} frames")
+        rows.append(np.full(i.size,k))
+        columns.append(i*shape[1]+j)
+    rows = np.concatenate(rows) if rows else np.zeros(0,dtype=np.int64)
+    columns = np.concatenate(columns) if columns else np.zeros(0,dtype=np.int64)
+    return sparse.csr_matrix((np.ones(rows.size),(rows,columns)),shape=(len(masks),shape[0]*shape[1]))
+
+def label_image_to_matrix(labels,shape):
+    """Returns the sparse (number of roi, Y*X) matrix summing the pixels of each ROI of a label image over a flattened frame
+        The ROIs of a segmentation are taken as they are, without going through their contours and contours_to_masks.
+        Pixel [y][x] of the label image, point [x,y] of its contour (see segmentation.label_contours), reads the frame
+        at [x][y] like the masks, column x*shape[1]+y.
+
+    Args:
+        labels (array of int): (Y,X) label image of a segmentation, pixels of the k-th ROI being k+1
+        shape (tuple of int): (Y,X) shape of the frames
+
+    Raises:
+        IndexError: if a ROI has pixels out of the frame as it is read, see masks_to_matrix
+    """
+    from scipy import sparse
+    y,x = np.nonzero(labels)
+    rows = labels[y,x]-1
+    outside = (x >= shape[0]) | (y >= shape[1])
+    if outside.any():
+        raise IndexError(f"ROI {rows[outside].min()} has pixels out of the {shape[0]}x{shape[1]} frames")
+    return sparse.csr_matrix((np.ones(y.size),(rows,x*shape[1]+y)),shape=(int(labels.max(initial=0)),shape[0]*shape[1]))
+
+def matrix_to_label_image(weights,shape):
+    """Returns the label image of the ROIs of a matrix from masks_to_matrix, pixels of the k-th ROI being k+1 (later ROIs covering earlier ones)
+        The image is indexed like the frames read by compute_dff, pixel [i][j] being column i*X+j
+
+    Args:
+        weights (sparse matrix): (number of roi, Y*X) matrix from masks_to_matrix
+        shape (tuple of int): (Y,X) shape of the frames
+    """
+    rows,columns = weights.nonzero()
+    labels = np.zeros(shape[0]*shape[1],dtype=np.int32)
+    order = np.argsort(rows,kind="stable")
+    labels[columns[order]] = rows[order]+1
+    return labels.reshape(shape)
+
+def neuropil_matrix(labels,roi_cnt,inner=2,outer=15):
+    """Returns the sparse (number of roi, Y*X) matrix averaging the neuropil annulus of each ROI over a flattened frame
+        The annulus of a ROI is every pixel between inner (excluded) and outer (included) pixels away from it that isn't in a ROI,
+        annuli of neighbouring ROIs overlapping. Distances are computed on the ROI's bounding box grown by outer.
+        ROIs without annulus get an empty row.
+
+    Args:
+        labels (array of int): (Y,X) label image, 0 for pixels out of ROIs, see matrix_to_label_image
+        roi_cnt (int): number of ROIs
+        inner (float,optional): gap in pixels left between ROIs and their annulus. Defaults to 2
+        outer (float,optional): outer radius in pixels of annuli. Defaults to 15
+    """
+    from scipy import ndimage, sparse
+    if roi_cnt == 0:
+        return sparse.csr_matrix((0,labels.size))
+    margin = int(np.ceil(outer))
+    rows,columns,values = [],[],[]
+    for i,box in enumerate(ndimage.find_objects(labels,roi_cnt)):
+        if box is None:
+            continue # ROI hidden by others
+        box = tuple(slice(max(0,s.start-margin),min(size,s.stop+margin)) for s,size in zip(box,labels.shape))
+        crop = labels[box]
+        distance = ndimage.distance_transform_edt(crop != i+1)
+        y,x = np.nonzero((crop == 0) & (distance > inner) & (distance <= outer))
+        if y.size:
+            rows.append(np.full(y.size,i))
+            columns.append(np.ravel_multi_index((y+box[0].start,x+box[1].start),labels.shape))
+            values.append(np.full(y.size,1/y.size))
+    if not rows:
+        return sparse.csr_matrix((roi_cnt,labels.size))
+    return sparse.csr_matrix((np.concatenate(values),(np.concatenate(rows),np.concatenate(columns))),shape=(roi_cnt,labels.size))
+
+def compute_dff(reader,masks,channel=0,workers=None,chunk_frames=64,progress=None,cancel=None,neuropil_factor=None,neuropil_radii=(2,15)):
     """Computes dF/F0 for ROIs defined by their masks, static over the video
+        Masks are compiled once into a sparse matrix, F of each block of frames being its product with the block.
+        Blocks are shared between workers threads, each reading with its own reader.reopen(workers=1) (the threads already
+        decoding in parallel), and written at their place in F.
+        With several channels, the frames of every channel over a block are read together and go through a single product.
+        With neuropil_factor, neuropil annuli (see neuropil_matrix) are stacked under the ROIs in the same matrix, their mean
+        being extracted by the same product, and F-neuropil_factor*neuropil*ROI area is returned as corrected F.
 
     Args:
         reader (dataReader): dataReader from which to pull images from
-        masks (list of mask): Masks delimiting ROIs
-        channel (int,optional): Channel in the file to pull images from. Defaults to the first one
+        masks (list of mask or array of int): Masks delimiting ROIs, or the (Y,X) label image of segmented ROIs (see label_image_to_matrix)
+        channel (int or list of int,optional): Channel in the file to pull images from, or channels. Defaults to the first one
+        workers (int,optional): number of threads. Defaults to the number of CPUs, 1 reading with reader in the calling thread
+        chunk_frames (int,optional): number of frames per block. Defaults to 64
+        progress (function,optional): called from the calling thread with the numbers of frames done and of frames as blocks finish
+        cancel (threading.Event,optional): stops the computation once set, blocks being processed being finished first
+        neuropil_factor (float,optional): fraction of the neuropil signal subtracted from ROIs, 0.7 being usual. Defaults to None for no correction
+        neuropil_radii (tuple of float,optional): inner and outer radius of the neuropil annuli. Defaults to (2,15)
     
     Returns:
-        array of float: 2d array (number of roi, time) of F
-        array of float: 2d array (number of roi, time) of dF/F0
+        array of float: 2d array (number of roi, time) of F, 3d array (channel, number of roi, time) for a list of channels
+        array of float: 2d array (number of roi, time) of dF/F0, 3d array (channel, number of roi, time) for a list of channels
+        array of float: with neuropil_factor, 2d array (number of roi, time) of corrected F, 3d array for a list of channels
+
+    Raises:
+        concurrent.futures.CancelledError: if cancel was set
     """
-    roi_cnt,slice_cnt = len(masks),int(reader.metadata["SizeT"])
-    dff = np.zeros((roi_cnt,slice_cnt),float)
-    f0 = np.zeros(roi_cnt,float)
-    for t in range(slice_cnt):
-        print(t)
-        image = reader.get_slice(channel,t)
-        for k in range(roi_cnt):
-            f = 0.
-            sizeX,sizeY = np.shape(masks[k][1])
-            for i in range(sizeX):
-                for j in range(sizeY):
-                    if masks[k][1][i][j]: f += image[masks[k][0][0]+i][masks[k][0][1]+j]
-            dff[k][t] = f
-            f0[k] += f
-    #Replace F with (F-F0)/F0
-    f_array = dff.copy()
-    for k in range(roi_cnt):
-        f0[k] /= slice_cnt
-        for t in range(slice_cnt):
-            dff[k][t] = (dff[k][t]-f0[k])/f0[k]
-    return f_array,dff
\ No newline at end of file
+    channels = list(channel) if isinstance(channel,(list,tuple,np.ndarray)) else [channel]
+    slice_cnt = int(reader.metadata["SizeT"])
+    workers = workers or os.cpu_count() or 1
+    cancel = cancel or threading.Event()
+    shape = reader.get_slice(channels[0],0).shape
+    weights = label_image_to_matrix(masks,shape) if isinstance(masks,np.ndarray) else masks_to_matrix(masks,shape)
+    roi_cnt = weights.shape[0]
+    if neuropil_factor is not None:
+        from scipy import sparse
+        areas = np.asarray(weights.sum(axis=1)).ravel()
+        weights = sparse.vstack([weights,neuropil_matrix(matrix_to_label_image(weights,shape),roi_cnt,*neuropil_radii)],format="csr")
+    traces = np.zeros((len(channels),weights.shape[0],slice_cnt),float) #F of ROIs, then neuropil means
+    starts = range(0,slice_cnt,chunk_frames)
+
+    def extract(reader,start):
+        #Frames of the block of every channel side by side, the pages of one time range being read one after the other
+        stop = min(start+chunk_frames,slice_cnt)
+        frames = np.concatenate([reader.read_frames(c,start,stop).reshape(stop-start,-1) for c in channels])
+        #(number of roi, Y*X) by (Y*X, channels*frames of the block)
+        traces[:,:,start:stop] = (weights @ frames.T).reshape(-1,len(channels),stop-start).transpose(1,0,2)
+        return stop-start
+
+    done = 0
+    if workers == 1:
+        for start in starts:
+            if cancel.is_set():
+                raise CancelledError()
+            done += extract(reader,start)
+            if progress: progress(done,slice_cnt)
+    else:
+        local,readers = threading.local(),[]
+        def work(start):
+            if cancel.is_set():
+                return 0
+            if not hasattr(local,"reader"):
+                local.reader = reader.reopen(workers=1)
+                readers.append(local.reader)
+            return extract(local.reader,start)
+        try:
+            with ThreadPoolExecutor(workers) as pool:
+                for future in as_completed([pool.submit(work,start) for start in starts]):
+                    done += future.result()
+                    if progress and not cancel.is_set(): progress(done,slice_cnt)
+        finally:
+            for opened in readers:
+                opened.close()
+        if cancel.is_set():
+            raise CancelledError()
+    #(F-F0)/F0, F0 being the mean of F
+    f_array = traces[:,:roi_cnt]
+    f0 = f_array.sum(axis=-1,keepdims=True)/slice_cnt
+    dff = (f_array-f0)/f0
+    results = [f_array,dff]
+    if neuropil_factor is not None:
+        results.append(f_array-neuropil_factor*traces[:,roi_cnt:]*areas[:,np.newaxis])
+    if len(channels) == 1 and not isinstance(channel,(list,tuple,np.ndarray)):
+        results = [result[0] for result in results]
+    return tuple(results)
+
+if __name__ == '__main__':
+    #python roiComputation.py : checks the masks against cv2.pointPolygonTest on random and segmented contours
+    import time
+    rng = np.random.default_rng(0)
+    contours = []
+    for _ in range(200):
+        center = rng.integers(10,200,2)
+        angles = np.sort(rng.uniform(0,2*np.pi,rng.integers(1,12)))
+        radius = rng.uniform(0,15,angles.size)
+        contours.append(np.round(center+np.stack([radius*np.cos(angles),radius*np.sin(angles)],axis=1)).astype(np.int32))
+    contours.append(np.array([[-3,-2],[6,1],[2,9]],dtype=np.int32)) #Partly at negative coordinates
+    start = time.perf_counter()
+    masks = contours_to_masks(contours)
+    print(f"{len(contours)} masks in {1000*(time.perf_counter()-start):.1f} ms")
+    for contour,((minX,minY),mask) in zip(contours,masks):
+        maxX,maxY = contour[:,0].max(),contour[:,1].max()
+        for x in range(max(maxX+1,0)):
+            for y in range(max(maxY+1,0)):
+                inside = cv2.pointPolygonTest(contour.reshape(-1,1,2),(x,y),False) >= 0
+                inMask = minX <= x < minX+mask.shape[0] and minY <= y < minY+mask.shape[1] and mask[x-minX][y-minY]
+                assert inside == inMask,f"Pixel ({x},{y}) of contour {contour.tolist()} : {inMask} instead of {inside}"
+    print("Masks match cv2.pointPolygonTest")
@@ -1,69 +1,324 @@
+import threading
+from pathlib import Path
 import numpy as np
 import cv2
-from tensorflow.keras.models import load_model
+
+from numpyUnet import WEIGHTS_PATH
+from segmentationCache import file_digest
+
+MODEL_PATH = Path(__file__).parent/"model_unet.keras"
+MIN_ROI_AREA = 50  # Pixels, smaller ROIs are dropped
+MAX_ROI_AREA = 250  # Pixels, larger ROIs are split into the touching cells they hold
+
+def filter_labels(labels, min_area=MIN_ROI_AREA):
+    """Drops the ROIs of a label image under min_area pixels, on pixel counts of all labels at once, and renumbers the others from 1"""
+    areas = np.bincount(labels.ravel())
+    keep = areas > min_area
+    keep[0] = False
+    renumber = np.zeros(areas.size, dtype=np.int32)
+    renumber[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    return renumber[labels]
+
+def grow_seeds(seeds, mask, elevation):
+    """
+    Labels the pixels of a mask by a watershed of elevation flooded from seeds
+
+    Flooding stays inside the mask, so each connected component of the mask is shared between its own seeds only,
+    touching cells being split along the ridges of elevation between them. Components without seeds stay 0.
+
+    Args:
+        seeds (numpy.ndarray): (Y, X) label image of the seeds, inside the mask
+        mask (numpy.ndarray): (Y, X) bool image
+        elevation (numpy.ndarray): (Y, X) image, low at the seeds, such as minus the distance to the background
+
+    Returns:
+        numpy.ndarray: (Y, X) int32 label image
+    """
+    from skimage.segmentation import watershed
+    if not seeds.any():
+        return np.zeros(mask.shape, dtype=np.int32)
+    # 8-connected flooding, like the components it splits
+    return watershed(elevation, seeds.astype(np.int32), mask=mask, connectivity=2).astype(np.int32)
+
+def label_contours(labels):
+    """
+    Outer contours of the ROIs of a label image, for display and ROI files
+
+    Args:
+        labels (numpy.ndarray): (Y, X) label image, 0 for the background and i for the pixels of the i-th ROI
+
+    Returns:
+        list: contour of the ROI of label i+1 at index i, as a list of [x, y] points
+    """
+    from scipy import ndimage
+    contours = []
+    for index, box in enumerate(ndimage.find_objects(labels), 1):
+        if box is None:
+            contours.append([])
+            continue
+        roi = (labels[box] == index).astype(np.uint8)
+        found, _ = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(box[1].start, box[0].start))
+        contours.append(max(found, key=cv2.contourArea)[:, 0, :].tolist())
+    return contours
 
 class Segmentation:
-    def __init__(self):
-        """Loads the U-Net segmentation model"""
-        self.model = load_model("script\model_unet.keras")
-        print(" Model successfully loaded")
+    def __init__(self, model_path=None, backend="keras", cache=None):
+        """Prepares the U-Net segmentation model
+
+        The model is loaded the first time it is used, or ahead of time by load_async.
 
-    def segment(self, img):
+        Args:
+            model_path (str,optional): model file. Defaults to model_unet.keras (or model_unet.npz for the numpy backend) next to this file
+            backend (str,optional): "keras" to run the model with TensorFlow, "numpy" to run it with NumPy from weights
+                exported by numpyUnet.export_weights, "auto" for numpy when the exported weights are there. Defaults to "keras"
+            cache (segmentationCache.SegmentationCache,optional): cache of the probability maps and label images of frames already
+                segmented with the same model and parameters. Defaults to None
         """
-        Performs image segmentation and processes detected contours.
+        if backend == "auto":
+            weights_path = Path(model_path) if model_path else WEIGHTS_PATH
+            backend = "numpy" if weights_path.suffix == ".npz" and weights_path.exists() else "keras"
+        if backend not in ("keras","numpy"):
+            raise ValueError(f"Unknown backend {backend}, use keras or numpy")
+        self.backend = backend
+        self.model_path = model_path or (MODEL_PATH if backend == "keras" else WEIGHTS_PATH)
+        self.cache = cache
+        self._model = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def model(self):
+        """The model, loaded on first access : a Keras model or a numpyUnet.NumpyUnet"""
+        with self._lock:
+            if self._model is None:
+                if self.backend == "numpy":
+                    from numpyUnet import NumpyUnet # No TensorFlow
+                    self._model = NumpyUnet(self.model_path)
+                else:
+                    from tensorflow.keras.models import load_model
+                    self._model = load_model(self.model_path)
+                print(" Model successfully loaded")
+            return self._model
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    def load_async(self):
+        """Loads the model and runs a first prediction from a background thread, so that the first segmentation doesn't wait"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._warm_up,daemon=True)
+            self._thread.start()
+
+    def _warm_up(self):
+        try:
+            self.predict(np.zeros((1,360,360),dtype=np.float32))
+        except Exception as e:
+            # Left for the first segmentation to report
+            print(f" Model warm-up failed : {e}")
+
+    def _prepare(self, img):
+        """Resizes a frame to the model input size and normalizes it, as a (360, 360) float32 array"""
+        img_resized = cv2.resize(img, (360, 360))  # Adjust to model input size
+        return self._normalize(img_resized)
+
+    def _normalize(self, img):
+        return img.astype(np.float32) / 255.0
+
+    def predict(self, batch):
+        """Runs the model on a (n, 360, 360) batch of prepared frames
+
+        Returns:
+            numpy.ndarray: (n, 360, 360) probability maps
+        """
+        return np.asarray(self.model.predict_on_batch(batch[..., np.newaxis]))[..., 0]
+
+    def _cache_key(self, img, tiled):
+        """Key of the results of a frame in the cache, covering everything the probability map depends on"""
+        params = {"backend": self.backend, "input": "tiled" if tiled else "resized",
+                  "size": 360, "overlap": 64, "scale": 255.0, "min_area": MIN_ROI_AREA, "max_area": MAX_ROI_AREA}
+        return self.cache.key(img, params, file_digest(self.model_path))
+
+    def _probabilities(self, frames, indexes, tiled=False, batch_size=16):
+        """Probability maps of frames[indexes], from the cache when there is one and the model for frames it doesn't hold"""
+        keys = [self._cache_key(frames[t], tiled) for t in indexes] if self.cache is not None else [None]*len(indexes)
+        probabilities = [None]*len(indexes)
+        for i, key in enumerate(keys):
+            entry = self.cache.get(key) if key else None
+            if entry is not None:
+                probabilities[i] = entry[0]
+        missing = [i for i, probability in enumerate(probabilities) if probability is None]
+        if missing:
+            if tiled:
+                predicted = self.predict_tiled(self._normalize(np.stack([frames[indexes[i]] for i in missing])), batch_size=batch_size)
+            else:
+                predicted = self.predict(np.stack([self._prepare(frames[indexes[i]]) for i in missing]))
+            for i, probability in zip(missing, predicted):
+                probabilities[i] = probability
+                if keys[i]:
+                    self.cache.put(keys[i], probability)
+        return np.stack(probabilities)
+
+    def _tile_starts(self, size, tile, overlap):
+        """First pixels of tiles covering size pixels with at least overlap pixels shared by neighbouring tiles"""
+        if size <= tile:
+            return [0]
+        count = int(np.ceil((size - overlap) / (tile - overlap)))
+        return np.round(np.linspace(0, size - tile, count)).astype(int)
+
+    def predict_tiled(self, frames, tile=360, overlap=64, batch_size=16):
+        """
+        Runs the model on overlapping tiles of normalized frames at their own resolution
+
+        Tiles of every frame are predicted batch_size at a time. Where tiles overlap, probabilities are blended with
+        a sine window so that pixels near tile borders, which the model sees with less context, count less.
+
+        Args:
+            frames (numpy.ndarray): (n, Y, X) normalized frames. Frames smaller than a tile are padded by reflection
+            tile (int,optional): tile size, the model input size. Defaults to 360
+            overlap (int,optional): minimum number of pixels shared by neighbouring tiles. Defaults to 64
+            batch_size (int,optional): number of tiles per model call. Defaults to 16
+
+        Returns:
+            numpy.ndarray: (n, Y, X) probability maps
+        """
+        n, size_y, size_x = frames.shape
+        pad_y, pad_x = max(0, tile - size_y), max(0, tile - size_x)
+        if pad_y or pad_x:
+            frames = np.pad(frames, ((0, 0), (0, pad_y), (0, pad_x)), mode="reflect")
+        height, width = frames.shape[1:]
+        corners = [(y, x) for y in self._tile_starts(height, tile, overlap) for x in self._tile_starts(width, tile, overlap)]
+
+        # Window never reaching zero, so that frame borders covered by a single tile are kept
+        ramp = np.sin(np.pi * (np.arange(tile) + 0.5) / tile).astype(np.float32)
+        window = np.outer(ramp, ramp)
+        weight = np.zeros((height, width), dtype=np.float32)
+        for y, x in corners:
+            weight[y:y+tile, x:x+tile] += window
+
+        total = np.zeros((n, height, width), dtype=np.float32)
+        tiles = [(i, y, x) for i in range(n) for y, x in corners]
+        for start in range(0, len(tiles), batch_size):
+            batch_tiles = tiles[start:start+batch_size]
+            batch = np.stack([frames[i, y:y+tile, x:x+tile] for i, y, x in batch_tiles])
+            for (i, y, x), probability in zip(batch_tiles, self.predict(batch)):
+                total[i, y:y+tile, x:x+tile] += probability * window
+        return (total / weight)[:, :size_y, :size_x]
+
+    def segment(self, img, tiled=False):
+        """
+        Performs image segmentation into a label image of the ROIs.
 
         Args:
             img (numpy.ndarray): Input image.
+            tiled (bool,optional): segment overlapping tiles of the image at full resolution (see predict_tiled) rather
+                than the image resized to the model input size. Defaults to False
 
         Returns:
-            list: List of processed contours.
+            numpy.ndarray: (Y, X) int32 label image of the ROIs, see _labels. label_contours gives their contours
         """
         if img is None:
             print(" No image provided for segmentation.")
-            return []
+            return None
 
-        # Resize and normalize the image
-        original_size = (img.shape[1], img.shape[0])  # Store original size
-        img_resized = cv2.resize(img, (360, 360))  # Adjust to model input size
-        img_resized = img_resized.astype(np.float32) / 255.0  # Normalize
-        img_resized = np.expand_dims(img_resized, axis=[0, -1])  # Format (1, 360, 360, 1)
+        key = self._cache_key(img, tiled) if self.cache is not None else None
+        entry = self.cache.get(key) if key else None
+        if entry is not None and entry[1] is not None:
+            return entry[1]
 
-        # Predict the segmentation mask
-        mask_pred = self.model.predict(img_resized)[0]
-        mask_pred = (mask_pred > 0.5).astype(np.uint8)  # Apply binary threshold
-        mask_pred = cv2.resize(mask_pred, original_size)  # Resize back to original dimensions
+        # Predict the segmentation mask, unless a batch path already cached it
+        if entry is not None:
+            probability = entry[0]
+        elif tiled:
+            probability = self.predict_tiled(self._normalize(img)[np.newaxis])[0]
+        else:
+            probability = self.predict(self._prepare(img)[np.newaxis])[0]
+        mask_pred = (probability > 0.5).astype(np.uint8)  # Apply binary threshold
+        labels = self._labels(mask_pred, (img.shape[1], img.shape[0]))
+        if key:
+            self.cache.put(key, probability, labels)
+        return labels
 
-        # Normalize and binarize the predicted mask
-        gray = cv2.normalize(mask_pred, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-        _, thresh = cv2.threshold(gray, 100, 255, cv2.THRESH_BINARY)
+    def segment_stack(self, frames, batch_size=16, consensus="mean", sample=None, tiled=False):
+        """
+        Segments many frames of a recording into a single label image of the ROIs
 
-        # Detect contours
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        Frames are run through the model batch_size at a time and their probability maps are combined, so that
+        ROIs are those found consistently along the recording rather than on a single frame. With a cache, only
+        frames it doesn't hold are run through the model.
 
-        # Process contours
-        min_contour_area = 50
-        max_contour_area = 250
-        processed_contours = []
+        Args:
+            frames (numpy.ndarray): (T, Y, X) frames
+            batch_size (int,optional): number of frames per model call. Defaults to 16
+            consensus (str,optional): "mean" keeps pixels whose mean probability is over 0.5, "vote" pixels over 0.5 in
+                more than half of the frames. Defaults to "mean"
+            sample (int,optional): number of frames, evenly spread over the stack, to segment. Defaults to None for all of them
+            tiled (bool,optional): segment frames at full resolution by tiles, see predict_tiled. Defaults to False
 
-        for cnt in contours:
-            area = cv2.contourArea(cnt)
+        Returns:
+            numpy.ndarray: (Y, X) int32 label image of the ROIs, see _labels
+        """
+        if consensus not in ("mean", "vote"):
+            raise ValueError(f"Unknown consensus {consensus}, use mean or vote")
+        if frames is None or len(frames) == 0:
+            print(" No image provided for segmentation.")
+            return None
+        indexes = np.arange(len(frames)) if sample is None else np.unique(np.linspace(0, len(frames)-1, min(sample, len(frames))).astype(int))
 
-            if area > max_contour_area:
-                x, y, w, h = cv2.boundingRect(cnt)
+        total = np.zeros(frames.shape[1:] if tiled else (360, 360), dtype=np.float32)
+        # Tiled frames fill batches on their own
+        step = 1 if tiled else batch_size
+        for start in range(0, indexes.size, step):
+            probabilities = self._probabilities(frames, indexes[start:start+step], tiled, batch_size)
+            total += probabilities.sum(axis=0) if consensus == "mean" else (probabilities > 0.5).sum(axis=0)
+        mask_pred = (total > 0.5*indexes.size).astype(np.uint8)
+        return self._labels(mask_pred, (frames.shape[2], frames.shape[1]))
 
-                if w > h:
-                    cnt_left = cnt[cnt[:, :, 0] < x + w // 2]
-                    cnt_right = cnt[cnt[:, :, 0] >= x + w // 2]
-                    processed_contours.append(cnt_left)
-                    processed_contours.append(cnt_right)
-                else:
-                    cnt_top = cnt[cnt[:, :, 1] < y + h // 2]
-                    cnt_bottom = cnt[cnt[:, :, 1] >= y + h // 2]
-                    processed_contours.append(cnt_top)
-                    processed_contours.append(cnt_bottom)
-            elif area > min_contour_area:
-                processed_contours.append(cnt)
+    def _labels(self, mask_pred, original_size):
+        """
+        Turns a binary mask into the label image of the ROIs of a frame of original_size (width, height)
+
+        ROIs are the connected components of the mask, holes filled. Components over MAX_ROI_AREA pixels are split
+        into touching cells, then ROIs under MIN_ROI_AREA pixels are dropped and labels renumbered from 1.
+        """
+        from scipy import ndimage
+        mask = ndimage.binary_fill_holes(cv2.resize(mask_pred, original_size) > 0)  # Resize back to original dimensions
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8, ltype=cv2.CV_32S)
+        large = np.flatnonzero(stats[:, cv2.CC_STAT_AREA] > MAX_ROI_AREA)
+        large = large[large > 0]
+        if large.size:
+            labels = self._split_touching(labels, count, large)
+        return filter_labels(labels)
+
+    def _split_touching(self, labels, count, components, radius=4):
+        """
+        Splits components of a label image into cells around the maxima of their distance transform
+
+        Markers are the regional maxima of the distance to the background at least radius pixels apart, nearby maxima
+        of a plateau being merged. Components with fewer than two markers are kept whole, the others are split between
+        their markers by a watershed of minus the distance (grow_seeds) and the pieces get labels after count.
+        """
+        from scipy import ndimage
+        from skimage.morphology import h_maxima
+        inside = np.isin(labels, components)
+        distance = ndimage.distance_transform_edt(inside)
+        # Regional maxima standing at least a pixel over their surroundings : not the ridge of a neck between cells
+        peaks = inside & (distance >= 2) & (distance == ndimage.maximum_filter(distance, size=2*radius+1)) & (h_maxima(distance, 1) > 0)
+        markers, marker_count = ndimage.label(ndimage.binary_dilation(peaks, iterations=2, mask=inside))
+        if marker_count < 2:
+            return labels
 
-        roi_contours = [cnt[:, 0, :].tolist() if cnt.ndim == 3 else cnt.tolist() for cnt in processed_contours if cnt is not None]
+        # Component of each marker, and components holding at least two of them
+        flat = markers > 0
+        pairs = np.unique(np.stack([markers[flat], labels[flat]]), axis=1)
+        component_of = np.zeros(marker_count + 1, dtype=np.int64)
+        component_of[pairs[0]] = pairs[1]
+        split = np.bincount(component_of[1:], minlength=count) >= 2
+        split[0] = False
+        region = split[labels]
+        if not region.any():
+            return labels
 
-        return roi_contours
\ No newline at end of file
+        grown = grow_seeds(np.where(split[component_of][markers] & flat, markers, 0), region, -distance)
+        # Pixels of split components the flooding didn't reach are dropped rather than keeping the label of the whole
+        return np.where(region, np.where(grown > 0, grown + count, 0), labels).astype(np.int32)
@@ -0,0 +1,111 @@
+import os
+import time
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_DIR = Path.home()/".cache"/"PR-image-segmentation"
+
+# SHA-256 of the files digested so far, by path, size and modification time
+_digests = dict()
+
+def file_digest(path):
+    """SHA-256 of a file's content, computed again only when its size or modification time change"""
+    stat = os.stat(path)
+    stamp = (str(path),stat.st_size,stat.st_mtime_ns)
+    if stamp not in _digests:
+        digest = hashlib.sha256()
+        with open(path,"rb") as file:
+            for block in iter(lambda: file.read(2**20),b""):
+                digest.update(block)
+        _digests[stamp] = digest.hexdigest()
+    return _digests[stamp]
+
+class SegmentationCache:
+    def __init__(self, cache_dir=DEFAULT_DIR, max_bytes=512*2**20):
+        """
+        Disk cache of segmentation results, addressed by the content of what produced them
+
+        Each entry is an .npz file named after a hash of the frame pixels, the segmentation parameters and the model
+        file digest, holding the probability map and, when known, the label image of the ROIs. Entries are evicted least recently
+        used first (by file modification time, updated on every hit) when the cache grows over max_bytes.
+
+        Args:
+            cache_dir (str,optional): directory of the cache, shared by all recordings. Defaults to ~/.cache/PR-image-segmentation
+            max_bytes (int,optional): maximum size of the cache on disk. Defaults to 512 MiB
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True,exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Entries left half written by an interrupted put, those of the last hour possibly being written by another process
+        for temporary in self.cache_dir.glob("*.npz.tmp"):
+            try:
+                if time.time()-temporary.stat().st_mtime > 3600:
+                    temporary.unlink()
+            except OSError:
+                pass
+        # Entries from least to most recently used, with their size
+        entries = sorted(self.cache_dir.glob("*.npz"),key=lambda path: path.stat().st_mtime_ns)
+        self._entries = OrderedDict((path.stem,path.stat().st_size) for path in entries)
+        self.nbytes = sum(self._entries.values())
+
+    def key(self, frame, params, model_digest):
+        """Hash of a frame's pixels, of the parameters (a dict of plain values) and of the model file digest"""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{frame.dtype.str}{frame.shape}{sorted(params.items())}{model_digest}".encode())
+        digest.update(np.ascontiguousarray(frame).data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir/f"{key}.npz"
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        """Returns the probability map and label image (None if it wasn't stored) of an entry, or None on a miss"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with np.load(self._path(key)) as data:
+                probability = data["probability"]
+                labels = data["labels"] if "labels" in data.files else None
+            os.utime(self._path(key))
+        except (OSError,ValueError,KeyError):
+            # Removed or damaged by another process
+            self._forget(key)
+            return None
+        return probability,labels
+
+    def put(self, key, probability, labels=None):
+        """Stores a probability map and optionally the label image of its ROIs, then evicts entries over max_bytes"""
+        arrays = {"probability":probability} if labels is None else {"probability":probability,"labels":labels}
+        path = self._path(key)
+        temporary = path.with_name(path.name+".tmp") # Not matched by *.npz when the cache is opened
+        with open(temporary,"wb") as file:
+            np.savez_compressed(file,**arrays) # A file object keeps numpy from appending .npz
+        os.replace(temporary,path) # Readers never see a partial entry
+        with self._lock:
+            self.nbytes += path.stat().st_size-self._entries.pop(key,0)
+            self._entries[key] = path.stat().st_size
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                evicted,size = self._entries.popitem(last=False)
+                self.nbytes -= size
+                self._path(evicted).unlink(missing_ok=True)
+
+    def _forget(self, key):
+        with self._lock:
+            self.nbytes -= self._entries.pop(key,0)
+
+    def clear(self):
+        with self._lock:
+            for key in self._entries:
+                self._path(key).unlink(missing_ok=True)
+            self._entries.clear()
+            self.nbytes = 0
@@ -0,0 +1,79 @@
+import sys
+import time
+import numpy as np
+from segmentation import Segmentation
+from summarySegmentation import SummarySegmentation
+from numpyUnet import WEIGHTS_PATH
+
+def roi_iou(reference, labels):
+    """Compares two label images
+
+    Returns:
+        float: mean over the reference ROIs of their best IoU with an ROI of labels (1 when there are no reference ROIs)
+        float: IoU of the pixels of all ROIs
+    """
+    count_reference, count = int(reference.max()), int(labels.max())
+    # Pixels shared by each pair of labels, 0 being the background
+    joint = np.bincount(reference.ravel()*(count+1)+labels.ravel(), minlength=(count_reference+1)*(count+1)).reshape(count_reference+1, count+1)
+    area_reference, area = joint.sum(axis=1), joint.sum(axis=0)
+    inter = joint[1:, 1:]
+    union = area_reference[1:, None]+area[None, 1:]-inter
+    iou = inter/np.maximum(union, 1)
+    best = iou.max(axis=1).mean() if count_reference and count else float(count_reference == 0)
+    roi_pixels = joint[1:, 1:].sum()
+    all_pixels = area_reference[1:].sum()+area[1:].sum()-roi_pixels
+    return float(best), float(roi_pixels/all_pixels) if all_pixels else 1.
+
+def default_modes(weights_path=WEIGHTS_PATH):
+    """Segmentation modes compared by segmentation_report : the numpy U-Net on resized frames (the reference),
+    by tiles at full resolution, and the segmentation without a model (summarySegmentation) of each frame
+
+    Returns:
+        dict: name of each mode and the function segmenting a frame into a label image
+    """
+    unet = Segmentation(weights_path, "numpy")
+    return {"U-Net":unet.segment, "U-Net tiled":lambda frame: unet.segment(frame, True), "no model":SummarySegmentation().segment}
+
+def segmentation_report(frames, modes=None):
+    """
+    Segments frames with each mode and compares the ROIs with those of the first mode
+
+    Args:
+        frames (numpy.ndarray): (T, Y, X) frames of a recording
+        modes (dict,optional): name of each mode and the function segmenting a frame into a label image, the first one
+            being the reference. Defaults to default_modes()
+
+    Returns:
+        list of dict: for each mode, "mode", "seconds_per_frame", "roi_count" (mean per frame), "roi_iou" (mean best IoU
+        of the reference ROIs) and "mask_iou" (IoU of the pixels of all ROIs with the reference), averaged over the frames
+    """
+    modes = default_modes() if modes is None else modes
+    results = []
+    reference = None
+    for name, segment in modes.items():
+        segment(frames[0]) # Loading isn't timed
+        start = time.perf_counter()
+        labels = [segment(frame) for frame in frames]
+        elapsed = time.perf_counter()-start
+        reference = labels if reference is None else reference
+        ious = np.array([roi_iou(expected, found) for expected, found in zip(reference, labels)])
+        results.append({"mode":name, "seconds_per_frame":elapsed/len(frames), "roi_count":float(np.mean([frame_labels.max() for frame_labels in labels])),
+                        "roi_iou":float(ious[:, 0].mean()), "mask_iou":float(ious[:, 1].mean())})
+    return results
+
+def format_report(results):
+    """Formats the results of segmentation_report as a table"""
+    lines = ["mode         s/frame  frames/s  ROIs/frame  ROI IoU  mask IoU"]
+    for res in results:
+        lines.append(f"{res['mode']:11}  {res['seconds_per_frame']:7.3f}  {1/res['seconds_per_frame']:8.2f}  {res['roi_count']:10.1f}  {res['roi_iou']:7.3f}  {res['mask_iou']:8.3f}")
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    # python segmentationReport.py recording.ome.tiff [channel] [number of frames] : compares segmentation modes on frames spread over a channel
+    from dataReader import DataReader
+    reader = DataReader(sys.argv[1])
+    channel = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    indexes = np.unique(np.linspace(0, int(reader.metadata["SizeT"])-1, count).astype(int))
+    frames = np.stack([reader.get_slice(channel, int(t)) for t in indexes])
+    print(format_report(segmentation_report(frames)))
@@ -0,0 +1,228 @@
+import numpy as np
+import cv2
+
+from segmentation import filter_labels, grow_seeds
+
+SUMMARIES = ("mean","max","correlation")
+
+class SummaryImage:
+    def __init__(self, kind="correlation", bin_frames=1):
+        """
+        Summary image of a recording, accumulated block by block in a single pass
+
+            * mean : mean of every pixel over time
+            * max : maximum of every pixel over time
+            * correlation : mean correlation over time of every pixel with its 8 neighbours, cells standing out
+              as their pixels vary together. Consecutive frames can be summed bin_frames at a time first : transients
+              lasting several frames still correlate, for about bin_frames times less work
+
+        Args:
+            kind (str,optional): "mean", "max" or "correlation". Defaults to "correlation"
+            bin_frames (int,optional): number of consecutive frames summed together before correlating, a last
+                incomplete bin being left out. Recordings of fewer than 2 bins are correlated frame by frame. Defaults to 1
+        """
+        if kind not in SUMMARIES:
+            raise ValueError(f"Unknown summary image {kind}, use one of {SUMMARIES}")
+        if bin_frames < 1:
+            raise ValueError(f"bin_frames must be at least 1, not {bin_frames}")
+        self.kind = kind
+        self.bin_frames = bin_frames
+        self.count = 0
+        self.bins = 0 # Bins of frames correlated so far
+        self._sum = None
+
+    def add(self, frames):
+        """Adds a (n, Y, X) block of frames"""
+        frames = np.asarray(frames)
+        if self._sum is None:
+            self._sum = np.zeros(frames.shape[1:],dtype=np.float64)
+            self._max = np.full(frames.shape[1:],-np.inf)
+            if self.kind == "correlation":
+                self._squares = np.zeros(frames.shape[1:],dtype=np.float64)
+                # Products with the right, bottom, bottom right and bottom left neighbours, each pair counted once
+                self._products = [np.zeros((frames.shape[1]-dy,frames.shape[2]-abs(dx)),dtype=np.float64) for dy,dx in self._shifts]
+                self._bin = np.zeros(frames.shape[1:],dtype=np.float32) # Exact sums of up to 256 16-bit frames
+                self._binned = 0
+                self._first = [] # Frames of recordings too short to be binned, kept until there are 2 bins
+        if self.kind == "correlation" and self.bin_frames > 1:
+            if self.count < 2*self.bin_frames:
+                self._first.append(np.array(frames))
+            elif self.bins >= 2:
+                self._first = []
+        self.count += len(frames)
+        if self.kind == "max":
+            np.maximum(self._max,frames.max(axis=0),out=self._max)
+            return
+        # OpenCV accumulators sum in float64 frame by frame, exactly for integer pixels, without temporary arrays
+        if frames.dtype not in (np.uint8,np.uint16,np.float32,np.float64):
+            frames = frames.astype(np.float32)
+        if self.kind == "mean":
+            for frame in frames:
+                cv2.accumulate(frame,self._sum)
+            return
+        for frame in frames:
+            if self.bin_frames == 1:
+                self._correlate(frame)
+                continue
+            cv2.accumulate(frame,self._bin)
+            self._binned += 1
+            if self._binned == self.bin_frames:
+                self._correlate(self._bin)
+                self._bin[:] = 0
+                self._binned = 0
+
+    def _correlate(self, frame):
+        """Adds a frame, or a bin of frames, to the sums correlations are computed from"""
+        cv2.accumulate(frame,self._sum)
+        cv2.accumulateSquare(frame,self._squares)
+        for products,(dy,dx) in zip(self._products,self._shifts):
+            a,b = self._pair(frame,dy,dx)
+            cv2.accumulateProduct(a,b,products)
+        self.bins += 1
+
+    _shifts = ((0,1),(1,0),(1,1),(1,-1))
+
+    @staticmethod
+    def _pair(x, dy, dx):
+        """Views of x over the pixels having a (dy, dx) neighbour, and over these neighbours"""
+        height,width = x.shape[-2:]
+        if dx >= 0:
+            return x[...,:height-dy,:width-dx],x[...,dy:,dx:]
+        return x[...,:height-dy,-dx:],x[...,dy:,:width+dx]
+
+    def result(self):
+        """The (Y, X) float64 summary image"""
+        if self.count == 0:
+            raise ValueError("No frames were added")
+        if self.kind == "max":
+            return self._max.copy()
+        if self.kind == "mean":
+            return self._sum/self.count
+        if self.bins < 2 and self._first:
+            unbinned = SummaryImage(self.kind)
+            unbinned.add(np.concatenate(self._first))
+            return unbinned.result()
+        count = self.bins
+        mean = self._sum/count
+        variance = self._squares/count-mean**2
+        # Pixels that never change only keep rounding errors, of the order of the squares times the float64 precision
+        variance[variance <= 1e-13*self._squares/count] = 0
+        std = np.sqrt(variance)
+        total = np.zeros(mean.shape)
+        neighbours = np.zeros(mean.shape)
+        for products,(dy,dx) in zip(self._products,self._shifts):
+            mean_a,mean_b = self._pair(mean,dy,dx)
+            std_a,std_b = self._pair(std,dy,dx)
+            with np.errstate(divide="ignore",invalid="ignore"):
+                corr = (products/count-mean_a*mean_b)/(std_a*std_b)
+            corr[~np.isfinite(corr)] = 0 # Pixels that never change
+            # The correlation of a pair counts for both of its pixels
+            for total_view,neighbours_view in zip(self._pair(total,dy,dx),self._pair(neighbours,dy,dx)):
+                total_view += corr
+                neighbours_view += 1
+        return total/neighbours
+
+class SummarySegmentation:
+    def __init__(self, summary="correlation", cell_radius=5, threshold=1.5, peak_threshold=3., bin_frames=4):
+        """
+        Segmentation of cells on a summary image of the recording, without a model
+
+        Offers the segment / segment_stack interface of segmentation.Segmentation, returning label images alike,
+        for a quick look at many recordings. Cells are grown from the local maxima of the summary image, on the
+        pixels standing out from their surroundings (adaptive threshold).
+
+        Args:
+            summary (str,optional): summary image, see SummaryImage. Defaults to "correlation"
+            cell_radius (int,optional): typical cell radius in pixels, setting how far apart maxima are and the size
+                of the surroundings pixels are compared to. Defaults to 5
+            threshold (float,optional): pixels belong to cells when they are this many noise levels over their surroundings. Defaults to 1.5
+            peak_threshold (float,optional): same for the maxima cells are grown from. Defaults to 3
+            bin_frames (int,optional): consecutive frames summed before correlating, see SummaryImage. Defaults to 4
+        """
+        if summary not in SUMMARIES:
+            raise ValueError(f"Unknown summary image {summary}, use one of {SUMMARIES}")
+        self.summary = summary
+        self.cell_radius = cell_radius
+        self.threshold = threshold
+        self.peak_threshold = peak_threshold
+        self.bin_frames = bin_frames
+        self.cache = None
+
+    @property
+    def is_loaded(self):
+        return True # No model
+
+    def load_async(self):
+        pass
+
+    def segment(self, img, tiled=False):
+        """Segments a single frame, its own summary image. tiled is accepted for Segmentation compatibility, frames always being used at full resolution
+
+        Returns:
+            numpy.ndarray: (Y, X) int32 label image of the ROIs
+        """
+        if img is None:
+            print(" No image provided for segmentation.")
+            return None
+        return self.find_cells(np.asarray(img,dtype=np.float64))
+
+    def segment_stack(self, frames, batch_size=64, consensus="mean", sample=None, tiled=False):
+        """
+        Segments the summary image of frames, accumulated batch_size frames at a time
+
+        consensus and tiled are accepted for Segmentation compatibility, the summary image taking their place.
+
+        Args:
+            frames (numpy.ndarray): (T, Y, X) frames
+            batch_size (int,optional): number of frames added to the summary image at once. Defaults to 64
+            sample (int,optional): number of frames, evenly spread over the stack, to use. Defaults to None for all of them,
+                sampled frames not being binned
+
+        Returns:
+            numpy.ndarray: (Y, X) int32 label image of the ROIs
+        """
+        if frames is None or len(frames) == 0:
+            print(" No image provided for segmentation.")
+            return None
+        indexes = np.arange(len(frames)) if sample is None else np.unique(np.linspace(0,len(frames)-1,min(sample,len(frames))).astype(int))
+        summary = SummaryImage(self.summary,self.bin_frames if sample is None else 1)
+        for start in range(0,indexes.size,batch_size):
+            summary.add(frames[indexes[start:start+batch_size]])
+        return self.find_cells(summary.result())
+
+    def segment_reader(self, reader, channel=0, chunk_frames=64):
+        """Segments the summary image of a whole channel, read in a single pass with reader.iter_chunks
+
+        Returns:
+            numpy.ndarray: (Y, X) int32 label image of the ROIs
+        """
+        summary = SummaryImage(self.summary,self.bin_frames)
+        for _,block in reader.iter_chunks(channel,chunk_frames):
+            summary.add(block)
+        return self.find_cells(summary.result())
+
+    def find_cells(self, image):
+        """
+        Label image of the cells of a summary image
+
+        The image is smoothed and its local mean over a few cell sizes removed. Pixels over threshold times the
+        noise level (median absolute deviation) are foreground, maxima at least cell_radius apart and over
+        peak_threshold are cells, grown over the foreground by a watershed of the residual (segmentation.grow_seeds). Foreground without a maximum is dropped,
+        as are cells under segmentation.MIN_ROI_AREA pixels.
+        """
+        from scipy import ndimage
+        smooth = cv2.GaussianBlur(image.astype(np.float32),(0,0),1)
+        size = 8*self.cell_radius+1
+        residual = smooth-cv2.blur(smooth,(size,size),borderType=cv2.BORDER_REFLECT)
+        noise = 1.4826*np.median(np.abs(residual-np.median(residual))) or 1.
+        foreground = residual > self.threshold*noise
+        peaks = foreground & (residual > self.peak_threshold*noise) & (residual == ndimage.maximum_filter(residual,size=2*self.cell_radius+1))
+
+        # Foreground regions holding a maximum
+        regions,count = ndimage.label(foreground)
+        seeded = np.zeros(count+1,dtype=bool)
+        seeded[regions[peaks]] = True
+        seeded[0] = False
+        foreground = seeded[regions]
+        seeds,_ = ndimage.label(ndimage.binary_dilation(peaks,mask=foreground))
+        return filter_labels(grow_seeds(seeds,foreground,-residual))